@@ -0,0 +1,159 @@
+'''
+    2D hit reconstruction for the digitized atar. Strips are numbered in blocks of pixels_per_plane per
+    plane (like get_adjacent_strips), even planes measuring x and odd planes y. Fragments in adjacent
+    planes of the same event that are close in time are paired into candidate space points, with a sort
+    and binary searches per chunk instead of a loop over pairs, so events with thousands of fragments
+    stay cheap.
+'''
+
+import numpy as np
+import os
+
+#uproot and awkward are imported where they are used, like in energy_sharingv3.
+
+
+
+def decode_strips(strips, pixels_per_plane = 100):
+
+    '''
+        Plane (ceil(strip / pixels_per_plane)) and position in the plane (0 to pixels_per_plane - 1) of strip numbers.
+    '''
+
+    strips = np.asarray(strips).astype(np.int64)
+
+    planes = (strips + pixels_per_plane - 1) // pixels_per_plane
+    local = strips - 1 - (planes - 1) * pixels_per_plane
+
+    return planes, local
+
+
+def pair_planes(per_event, strips, energies, times, pixels_per_plane = 100, window = 5., pitch = 200.):
+
+    '''
+        Pairs the flat fragments of each event (given the number per event) in plane p with those in plane p + 1
+        no more than window apart in time. Fragments are sorted by event, plane and time, every fragment looks up
+        the time window of the next plane of its event with two searchsorted calls on a combined key, and the
+        pairs are expanded from the window bounds. Returns a dict of flat arrays, one entry per candidate point
+        sorted by event: the lower plane, the local strips measuring x and y, x and y (strip centers, pitch apart,
+        in the units of pitch), the summed energy, the mean time and the time difference (upper minus lower plane),
+        the indices of the two fragments in the input, and the number of points per event.
+    '''
+
+    per_event = np.asarray(per_event)
+    energies = np.asarray(energies)
+    times = np.asarray(times, dtype = np.float64)
+
+    events = np.repeat(np.arange(len(per_event)), per_event)
+    planes, local = decode_strips(strips, pixels_per_plane)
+
+    order = np.lexsort((times, planes, events))
+
+    #Dense rank of every (event, plane) group in sort order
+
+    groups = events[order] * (int(np.max(planes, initial = 0)) + 2) + planes[order]
+    group_values, rank = np.unique(groups, return_inverse = True)
+
+    #Times relative to the start of their event, so the combined key keeps its precision
+
+    event_start = np.full(len(per_event), np.inf)
+    np.minimum.at(event_start, events, times)
+
+    relative = times[order] - event_start[events[order]]
+    span = float(np.max(relative, initial = 0.)) + 2 * window + 1
+
+    keys = rank * span + relative
+
+    #Window of the next plane of the same event for every fragment
+
+    target = np.searchsorted(group_values, groups + 1)
+    found = (target < len(group_values)) & (group_values[np.minimum(target, len(group_values) - 1)] == groups + 1)
+
+    low = np.searchsorted(keys, target * span + relative - window, side = 'left')
+    high = np.searchsorted(keys, target * span + relative + window, side = 'right')
+
+    counts = np.where(found, high - low, 0)
+
+    #Expand every fragment into its pairs
+
+    total = int(np.sum(counts))
+    first = np.repeat(np.arange(len(order)), counts)
+    second = np.repeat(low, counts) + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    first = order[first]
+    second = order[second]
+
+    lower_even = planes[first] % 2 == 0
+
+    x_strip = np.where(lower_even, local[first], local[second])
+    y_strip = np.where(lower_even, local[second], local[first])
+
+    return {
+        'plane': planes[first],
+        'x_strip': x_strip,
+        'y_strip': y_strip,
+        'x': (x_strip + 0.5) * pitch,
+        'y': (y_strip + 0.5) * pitch,
+        'energy': energies[first] + energies[second],
+        'time': 0.5 * (times[first] + times[second]),
+        'dt': times[second] - times[first],
+        'first': first,
+        'second': second,
+        'per_event': np.bincount(events[first], minlength = len(per_event))
+    }
+
+
+def space_points(fragments, pixels_per_plane = 100, window = 5., pitch = 200.):
+
+    '''
+        Candidate space points of digitized events (an awkward record array like digitizeatar.digitize
+        returns, or a dict with pixel_hits, pixel_edep and pixel_time) as an awkward record array with one
+        list of points per event (see pair_planes; fragment indices are left out).
+    '''
+
+    import awkward as ak
+
+    points = pair_planes(
+        ak.to_numpy(ak.num(fragments['pixel_hits'])),
+        ak.to_numpy(ak.flatten(fragments['pixel_hits'])),
+        ak.to_numpy(ak.flatten(fragments['pixel_edep'])),
+        ak.to_numpy(ak.flatten(fragments['pixel_time'])),
+        pixels_per_plane, window, pitch
+    )
+
+    per_event = points.pop('per_event')
+
+    for name in ('first', 'second'):
+        points.pop(name)
+
+    return ak.zip(dict((name, ak.unflatten(values, per_event)) for name, values in points.items()), depth_limit = 1)
+
+
+def compute_space_points(digitized_path, pixels_per_plane = 100, window = 5., pitch = 200., tree = 'digitized_atar', step_size = "100 MB", output_dir = None):
+
+    '''
+        Writes the candidate space points of every entry of the tree (digitized_atar by default, or atar_frames)
+        of a digitized file to an atar_points tree, with the same entries, in a new file 'points <digitized_path>'
+        in output_dir (the current working directory by default) and returns its path. The input is streamed in
+        chunks of step_size.
+    '''
+
+    import uproot
+
+    dest = os.path.join(os.getcwd() if output_dir is None else output_dir, 'points' + os.path.basename(digitized_path))
+
+    branch_types = {
+        'plane': 'var * int32', 'x_strip': 'var * int32', 'y_strip': 'var * int32', 'x': 'var * float32', 'y': 'var * float32',
+        'energy': 'var * float32', 'time': 'var * float64', 'dt': 'var * float32'
+    }
+
+    with uproot.open(digitized_path) as infile, uproot.recreate(dest, compression = uproot.ZSTD(3)) as outfile:
+
+        outtree = outfile.mktree('atar_points', branch_types)
+
+        for fragments in infile[tree].iterate(['pixel_hits', 'pixel_edep', 'pixel_time'], step_size = step_size):
+
+            points = space_points(fragments, pixels_per_plane, window, pitch)
+
+            outtree.extend(dict((name, points[name]) for name in branch_types))
+
+    return dest
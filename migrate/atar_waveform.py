@@ -0,0 +1,192 @@
+'''
+    Waveform synthesis for the digitized atar: turns the strip fragments of a digitized_atar tree
+    into sampled waveforms, one per strip with energy in an event. Fragments are grouped per
+    (event, strip) channel, scattered onto a sample grid and convolved with a pulse template by FFT,
+    a whole chunk of events at a time, and the waveforms are written as an atar_waveforms tree with
+    one (strip, samples) entry per channel.
+'''
+
+import numpy as np
+import os
+
+#uproot, awkward and scipy are imported where they are used, like in energy_sharingv3.
+
+
+
+class pulsetemplate:
+
+    '''
+        Response of a strip to a unit energy deposit at t = 0, sampled every dt (pixel_time units, ns)
+        and normalized to a peak of 1, so waveforms come out in energy units times the gain.
+        Build one from an analytic shape with crrc or from a histogram with from_histogram.
+    '''
+
+    def __init__(self, values, dt):
+
+        values = np.asarray(values, dtype = np.float64)
+
+        if values.ndim != 1 or len(values) == 0 or not np.any(values):
+            raise ValueError('a pulse template needs a non zero 1D array of samples')
+
+        self.values = values / np.max(np.abs(values))
+        self.dt = float(dt)
+
+
+    def __len__(self):
+        return len(self.values)
+
+
+    def __repr__(self):
+        return 'pulsetemplate({0} samples, dt = {1})'.format(len(self.values), self.dt)
+
+
+    @classmethod
+    def crrc(cls, dt, tau = 20., order = 2, length = None):
+
+        '''
+            CR-RC^order shaper response (t / tau)^order exp(-t / tau), peaking at order * tau.
+            length is the number of samples, by default enough for 12 tau past the peak.
+        '''
+
+        if length is None:
+            length = int(np.ceil((order * tau + 12 * tau) / dt))
+
+        t = np.arange(length) * dt / tau
+
+        return cls(t ** order * np.exp(-t), dt)
+
+
+    @classmethod
+    def from_histogram(cls, path, histogram, dt = None):
+
+        '''
+            Template from a 1D histogram of the pulse shape (bin centers in ns) in a ROOT file, for
+            example one stored next to the pmax_histogram in the BNL response file. The pulse is
+            resampled every dt (the bin width if None) starting at the first bin center.
+        '''
+
+        import uproot
+
+        with uproot.open(path) as f:
+            values, edges = f[histogram].to_numpy()
+
+        centers = 0.5 * (edges[1:] + edges[:-1])
+
+        if dt is None:
+            dt = centers[1] - centers[0]
+
+        grid = np.arange(centers[0], centers[-1] + 0.5 * dt, dt)
+
+        return cls(np.interp(grid, centers, values), dt)
+
+
+
+def synthesize_waveforms(per_event, strips, energies, times, template, n_samples = 256, t_start = None, pretrigger = 20., gain = 1.):
+
+    '''
+        Waveforms of flat strip fragments given the number of fragments per event. The window of an event
+        is n_samples samples of template.dt from t_start, or from pretrigger before its earliest fragment if
+        t_start is None. Every fragment is split linearly between the two samples around its time (so timing
+        finer than dt survives), the deposits of each (event, strip) are summed on a (channel, sample) grid
+        with bincount and the grid is convolved with the template by FFT. Fragments outside the window are
+        left out. Returns the event index (within the given events), strip and window start of every channel
+        that got energy and its samples as a (channels, n_samples) array, times gain.
+    '''
+
+    from scipy.signal import fftconvolve
+
+    per_event = np.asarray(per_event)
+    strips = np.asarray(strips)
+    energies = np.asarray(energies, dtype = np.float64)
+    times = np.asarray(times, dtype = np.float64)
+
+    events = np.repeat(np.arange(len(per_event)), per_event)
+
+    #Window start of every event
+
+    if t_start is None:
+        starts = np.full(len(per_event), np.inf)
+        np.minimum.at(starts, events, times)
+        starts = starts - pretrigger
+    else:
+        starts = np.full(len(per_event), float(t_start))
+
+    position = (times - starts[events]) / template.dt
+    sample = np.floor(position).astype(np.int64)
+    inside = (sample >= 0) & (sample < n_samples)
+
+    events, strips, energies, position, sample = events[inside], strips[inside], energies[inside], position[inside], sample[inside]
+
+    #Channels are the (event, strip) pairs with a fragment in the window
+
+    keys = events.astype(np.int64) * (int(np.max(strips, initial = 0)) + 1) + strips
+    channel_keys, channel = np.unique(keys, return_inverse = True)
+
+    first = np.zeros(len(channel_keys), dtype = np.int64)
+    first[channel[::-1]] = np.arange(len(channel))[::-1]
+
+    channel_events = events[first]
+    channel_strips = strips[first]
+
+    #Deposits split between the two samples around each fragment
+
+    fraction = position - sample
+    late = sample + 1 < n_samples
+
+    grid = np.bincount(channel * n_samples + sample, weights = energies * (1 - fraction), minlength = len(channel_keys) * n_samples)
+    grid += np.bincount(channel[late] * n_samples + sample[late] + 1, weights = energies[late] * fraction[late], minlength = len(channel_keys) * n_samples)
+    grid = grid.reshape(len(channel_keys), n_samples)
+
+    if len(channel_keys):
+        waveforms = fftconvolve(grid, template.values[None, :], axes = 1)[:, :n_samples] * gain
+    else:
+        waveforms = grid
+
+    return channel_events, channel_strips, starts[channel_events], waveforms
+
+
+
+def compute_waveforms(digitized_path, template, n_samples = 256, t_start = None, pretrigger = 20., gain = 1., tree = 'digitized_atar', step_size = "100 MB", output_dir = None, compression = 'ZSTD', compression_level = 3, dtype = 'float32'):
+
+    '''
+        Writes the waveforms of the fragments in the tree (digitized_atar by default, or atar_frames for
+        time frames) of a digitized file to a new file 'waveforms <digitized_path>' in output_dir (the current
+        working directory by default) and returns its path. The atar_waveforms tree has one entry per channel
+        with the entry number it comes from (event), its strip, the start of its window (t_start) and its
+        n_samples samples (in dtype), so a chunk of it reads back as a (channels, n_samples) array. The input
+        is streamed in chunks of step_size and every chunk is synthesized at once (see synthesize_waveforms).
+    '''
+
+    import uproot
+    import awkward as ak
+
+    dest = os.path.join(os.getcwd() if output_dir is None else output_dir, 'waveforms' + os.path.basename(digitized_path))
+
+    if compression is not None and not isinstance(compression, uproot.compression.Compression):
+        compression = getattr(uproot, compression.upper())(compression_level)
+
+    branch_types = {'event': 'int64', 'strip': 'int32', 't_start': 'float64', 'samples': (np.dtype(dtype).name, (n_samples,))}
+
+    with uproot.open(digitized_path) as infile, uproot.recreate(dest, compression = compression) as outfile:
+
+        outtree = outfile.mktree('atar_waveforms', branch_types)
+
+        for data, report in infile[tree].iterate(['pixel_hits', 'pixel_edep', 'pixel_time'], step_size = step_size, report = True):
+
+            events, strips, starts, waveforms = synthesize_waveforms(
+                ak.to_numpy(ak.num(data['pixel_hits'])),
+                ak.to_numpy(ak.flatten(data['pixel_hits'])),
+                ak.to_numpy(ak.flatten(data['pixel_edep'])),
+                ak.to_numpy(ak.flatten(data['pixel_time'])),
+                template, n_samples, t_start, pretrigger, gain
+            )
+
+            if len(events):
+                outtree.extend({
+                    'event': events + report.tree_entry_start,
+                    'strip': strips.astype(np.int32),
+                    't_start': starts,
+                    'samples': waveforms.astype(dtype)
+                })
+
+    return dest
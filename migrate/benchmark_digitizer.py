@@ -0,0 +1,297 @@
+'''
+    Offline benchmark suite for the atar digitizer. It writes seeded synthetic atar trees and a
+    synthetic pmax_histogram response, times build_spline, get_adjacent_strips and
+    compute_energy_sharing over several sizes and saves the results as JSON, so runs of
+    different versions can be compared. Run it with
+
+        python benchmark_digitizer.py --events 1000 10000 --output bench.json
+'''
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import tempfile
+import argparse
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+
+def make_response_file(path, spline_width = 600, bins = 60, sigma = 150, seed = 0):
+
+    '''
+        Writes a synthetic BNL_Signal_Response style file holding a pmax_histogram: a gaussian
+        shaped charge sharing profile (in microns) over +- spline_width with a little noise.
+    '''
+
+    import uproot
+    import hist as Hist
+
+    rng = np.random.default_rng(seed)
+
+    h = Hist.Hist(Hist.axis.Regular(bins, -spline_width, spline_width, name = 'x'))
+    centers = h.axes[0].centers
+
+    h[...] = 1000 * np.exp(-0.5 * (centers / sigma) ** 2) * rng.normal(1, 0.01, bins)
+
+    with uproot.recreate(path) as f:
+        f['pmax_histogram'] = h
+
+    return path
+
+
+def make_atar_file(path, n_events = 1000, hits_per_event = 20, n_planes = 48, pixels_per_plane = 100, seed = 0, step_size = 10000):
+
+    '''
+        Writes a synthetic simulation file with an atar tree like the pienux productions: per event a
+        track entering at a random strip and crossing consecutive planes, drifting by a strip or so per
+        plane, with a poisson number of hits (mean hits_per_event), landau-like energy deposits (MeV),
+        increasing times (ns) and a pdg code per hit. Also writes a flat init tree with one entry per event.
+    '''
+
+    import uproot
+    import awkward as ak
+
+    rng = np.random.default_rng(seed)
+
+    branch_types = {
+        'pixel_hits': 'var * int32',
+        'pixel_edep': 'var * float64',
+        'pixel_time': 'var * float64',
+        'pixel_pdg': 'var * int32'
+    }
+
+    with uproot.recreate(path) as f:
+
+        atar = f.mktree('atar', branch_types)
+        init = f.mktree('init', {'beam_e': 'float64'})
+
+        for start in range(0, n_events, step_size):
+
+            events = min(step_size, n_events - start)
+            counts = rng.poisson(hits_per_event, events)
+            total = int(np.sum(counts))
+
+            #Position of each hit along its track
+
+            step = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+            first_plane = np.repeat(rng.integers(0, n_planes, events), counts)
+            first_strip = np.repeat(rng.integers(0, pixels_per_plane, events), counts)
+
+            plane = (first_plane + step // 2) % n_planes
+            strip = np.clip(first_strip + np.round(rng.normal(0, 1, total) * np.sqrt(step)).astype(int), 0, pixels_per_plane - 1)
+
+            hits = (plane * pixels_per_plane + strip + 1).astype(np.int32)
+            edep = rng.gamma(2.0, 0.05, total) + rng.exponential(0.02, total)
+            hit_time = np.repeat(rng.exponential(20, events), counts) + step * 0.01 + rng.exponential(0.005, total)
+            pdg = rng.choice(np.array([211, -13, -11, 11, 2212], dtype = np.int32), total, p = [0.6, 0.2, 0.1, 0.05, 0.05])
+
+            atar.extend({
+                'pixel_hits': ak.unflatten(hits, counts),
+                'pixel_edep': ak.unflatten(edep, counts),
+                'pixel_time': ak.unflatten(hit_time, counts),
+                'pixel_pdg': ak.unflatten(pdg, counts)
+            })
+
+            init.extend({'beam_e': rng.normal(55, 1, events)})
+
+    return path
+
+
+
+def _peak_rss():
+
+    '''
+        Peak resident memory of this process in MB.
+    '''
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _time_import():
+
+    '''
+        Time to import the digitizer in a fresh process.
+    '''
+
+    start = time.perf_counter()
+
+    import energy_sharingv3
+
+    return time.perf_counter() - start
+
+
+def _time_build_spline(spline_path, cache_dir):
+
+    '''
+        Times a cold build_spline (no cache), a build that fills the cache, and warm builds from
+        the disk and in process caches.
+    '''
+
+    import energy_sharingv3
+
+    energy_sharingv3.clear_spline_cache(cache_dir)
+
+    digitizer = energy_sharingv3.digitizeatar(spline_path, spline_cache_dir = cache_dir)
+    times = {}
+
+    for name, cache, clear in [('cold', False, False), ('fill', True, False), ('disk', True, True), ('memory', True, False)]:
+
+        if clear:
+            energy_sharingv3._spline_cache.clear()
+
+        start = time.perf_counter()
+        digitizer.build_spline(cache = cache)
+        times[name] = time.perf_counter() - start
+
+    return times
+
+
+def _time_adjacent_strips(spline_path, pixels_per_plane, n_calls = 100000):
+
+    '''
+        Times get_adjacent_strips per call over random strips.
+    '''
+
+    import energy_sharingv3
+
+    digitizer = energy_sharingv3.digitizeatar(spline_path, pixels_per_plane = pixels_per_plane)
+    strips = np.random.default_rng(0).integers(0, 10 * pixels_per_plane, n_calls).tolist()
+
+    start = time.perf_counter()
+
+    for strip in strips:
+        digitizer.get_adjacent_strips(strip)
+
+    return (time.perf_counter() - start) / n_calls
+
+
+def _time_compute(root_path, spline_path, output_dir, pixels_per_plane, options):
+
+    '''
+        Times compute_energy_sharing on a file and measures its throughput and peak memory.
+        Runs in its own process so the peak memory belongs to this case only.
+    '''
+
+    import uproot
+    import energy_sharingv3
+
+    with uproot.open(root_path + ':atar') as atar:
+        n_events = atar.num_entries
+        n_hits = int(np.sum(atar['npixel_hits'].array(library = 'np')))
+
+    digitizer = energy_sharingv3.digitizeatar(spline_path, pixels_per_plane = pixels_per_plane, backend = options.get('backend', 'numpy'))
+    spline = digitizer.build_spline()
+
+    start = time.perf_counter()
+    dest = digitizer.compute_energy_sharing(root_path, spline, step_size = options.get('step_size', '100 MB'), workers = options.get('workers', 1), output_dir = output_dir, pipeline = options.get('pipeline', False))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'events': n_events,
+        'hits': n_hits,
+        'seconds': elapsed,
+        'events_per_s': n_events / elapsed,
+        'hits_per_s': n_hits / elapsed,
+        'peak_rss_mb': _peak_rss(),
+        'output_mb': os.path.getsize(dest) / 1e6
+    }
+
+
+def _in_fresh_process(function, *args):
+
+    '''
+        Runs function(*args) in a newly spawned interpreter and returns its result.
+    '''
+
+    with ProcessPoolExecutor(1, mp_context = multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+
+def _git_revision():
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
+def run_benchmarks(events = (1000, 10000, 100000), hits_per_event = 20, n_planes = 48, pixels_per_plane = 100, seed = 0, options = None, workdir = None):
+
+    '''
+        Generates the synthetic inputs in workdir (a temporary directory, removed afterwards, by default) and runs every
+        benchmark, the compute_energy_sharing one once per number of events. options are passed on
+        to compute_energy_sharing (backend, step_size, workers, pipeline). Returns the results as a dict.
+    '''
+
+    options = dict(options or {})
+
+    if workdir is None:
+        with tempfile.TemporaryDirectory(prefix = 'atar_bench_') as workdir:
+            return run_benchmarks(events, hits_per_event, n_planes, pixels_per_plane, seed, options, workdir)
+
+    os.makedirs(workdir, exist_ok = True)
+
+    spline_path = make_response_file(os.path.join(workdir, 'BNL_Signal_Response.root'), seed = seed)
+
+    results = {
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'parameters': {'hits_per_event': hits_per_event, 'n_planes': n_planes, 'pixels_per_plane': pixels_per_plane, 'seed': seed, 'options': options},
+        'import_s': _in_fresh_process(_time_import),
+        'build_spline_s': _in_fresh_process(_time_build_spline, spline_path, os.path.join(workdir, 'spline_cache')),
+        'get_adjacent_strips_s': _time_adjacent_strips(spline_path, pixels_per_plane),
+        'compute_energy_sharing': []
+    }
+
+    for n_events in events:
+
+        root_path = make_atar_file(os.path.join(workdir, 'atar_{0}.root'.format(n_events)), n_events, hits_per_event, n_planes, pixels_per_plane, seed)
+
+        result = _in_fresh_process(_time_compute, root_path, spline_path, workdir, pixels_per_plane, options)
+        results['compute_energy_sharing'].append(result)
+
+        print('{events:>9} events {hits:>10} hits  {seconds:8.3f} s  {events_per_s:12.0f} events/s  {hits_per_s:12.0f} hits/s  {peak_rss_mb:8.1f} MB'.format(**result))
+
+    return results
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Benchmark the atar digitizer on synthetic data.')
+    parser.add_argument('--events', type = int, nargs = '+', default = [1000, 10000, 100000], help = 'numbers of events to benchmark')
+    parser.add_argument('--hits-per-event', type = float, default = 20)
+    parser.add_argument('--n-planes', type = int, default = 48)
+    parser.add_argument('--pixels-per-plane', type = int, default = 100)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--backend', default = 'numpy', choices = ['numpy', 'numba'])
+    parser.add_argument('--workers', type = int, default = 1)
+    parser.add_argument('--pipeline', action = 'store_true', help = 'overlap reading, computing and writing')
+    parser.add_argument('--step-size', default = '100 MB', help = 'entries or a size such as "100 MB"')
+    parser.add_argument('--workdir', default = None, help = 'where to write the synthetic files (a temporary directory by default)')
+    parser.add_argument('--output', default = 'benchmark_digitizer.json', help = 'JSON file for the results')
+    args = parser.parse_args()
+
+    step_size = int(args.step_size) if args.step_size.isdigit() else args.step_size
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    results = run_benchmarks(args.events, args.hits_per_event, args.n_planes, args.pixels_per_plane, args.seed, {'backend': args.backend, 'workers': args.workers, 'step_size': step_size, 'pipeline': args.pipeline}, args.workdir)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 2)
+
+    print('import {0:.3f} s, build_spline cold {1[cold]:.3f} s warm {1[disk]:.4f} s, get_adjacent_strips {2:.2e} s/call'.format(results['import_s'], results['build_spline_s'], results['get_adjacent_strips_s']))
+    print('results written to', args.output)
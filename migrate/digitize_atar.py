@@ -0,0 +1,230 @@
+'''
+    Command line batch digitization of atar simulation files. Every input (given as paths, globs or
+    @lists of paths) is digitized with compute_energy_sharing in a process pool whose workers build the
+    response spline once, and a summary line with timings and throughput is printed per file. Outputs
+    are written to a temporary name and renamed when complete, so files whose output exists are done
+    and skipped on the next call. Run it with
+
+        python digitize_atar.py 'sims/*.root' --spline BNL_Signal_Response.root --output-dir digitized --workers 4
+'''
+
+import os
+import sys
+import glob
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import energy_sharingv3
+
+
+
+def expand_inputs(inputs):
+
+    '''
+        Input files from paths, glob patterns and @files listing one path or pattern per line,
+        in order and without duplicates (the same file spelled differently counts once).
+    '''
+
+    paths = []
+
+    for item in inputs:
+
+        if item.startswith('@'):
+            with open(item[1:]) as f:
+                paths.extend(expand_inputs([line.strip() for line in f if line.strip() and not line.startswith('#')]))
+        elif glob.has_magic(item):
+            paths.extend(sorted(glob.glob(item)))
+        else:
+            paths.append(item)
+
+    unique = {}
+
+    for path in paths:
+        unique.setdefault(os.path.realpath(path), path)
+
+    return list(unique.values())
+
+
+def output_path(root_path, output_dir):
+    return os.path.join(output_dir, 'digitized' + os.path.basename(root_path))
+
+
+
+#Per worker digitizer and spline, set up once by _init_worker
+
+_worker = {}
+
+
+def _init_worker(settings):
+    '''
+    Builds the digitizer and its spline once in every worker process.
+    '''
+    _worker['digitizer'] = energy_sharingv3.digitizeatar(**settings)
+    _worker['spline'] = _worker['digitizer'].build_spline()
+
+
+def digitize_file(root_path, output_dir, options):
+
+    '''
+        Digitizes one file with the worker's digitizer into a hidden working directory of output_dir and
+        moves the output into output_dir once it is complete. Returns a summary dict.
+    '''
+
+    digitizer = _worker['digitizer']
+    digitizer.stats = stats = energy_sharingv3.digitizerstats()
+
+    workdir = os.path.join(output_dir, '.digitizing')
+    os.makedirs(workdir, exist_ok = True)
+
+    start = time.perf_counter()
+
+    dest = digitizer.compute_energy_sharing(root_path, _worker['spline'], output_dir = workdir, **options)
+    os.replace(dest, output_path(root_path, output_dir))
+
+    seconds = time.perf_counter() - start
+
+    return dict(stats.counts, input = root_path, output = output_path(root_path, output_dir), seconds = seconds,
+                read_s = stats.seconds['read'], compute_s = stats.seconds['compute'], write_s = stats.seconds['write'],
+                events_per_s = stats.counts['events'] / seconds, hits_per_s = stats.counts['hits'] / seconds)
+
+
+def summary_line(result):
+    return ('{input}: {events} events {hits} hits {fragments} fragments in {seconds:.2f} s '
+            '(read {read_s:.2f} s, compute {compute_s:.2f} s, write {write_s:.2f} s) '
+            '{events_per_s:.0f} events/s {hits_per_s:.0f} hits/s -> {output} ({bytes_written} bytes)').format(**result)
+
+
+def run(paths, settings, output_dir, options, workers = 1, overwrite = False):
+
+    '''
+        Digitizes every path not yet digitized in output_dir (all of them with overwrite) with
+        digitizeatar(**settings) and compute_energy_sharing(**options), printing a summary line per
+        file. Returns the summaries of the digitized files and the failed paths with their errors.
+        Raises ValueError, before digitizing anything, if two inputs would get the same output name.
+    '''
+
+    outputs = {}
+
+    for path in paths:
+        outputs.setdefault(output_path(path, output_dir), []).append(path)
+
+    collisions = [sources for sources in outputs.values() if len(sources) > 1]
+
+    if collisions:
+        raise ValueError('inputs with the same file name would overwrite each other in {0}: {1}'.format(
+            output_dir, '; '.join(', '.join(sources) for sources in collisions)))
+
+    os.makedirs(output_dir, exist_ok = True)
+
+    todo = []
+
+    for path in paths:
+        if not overwrite and os.path.exists(output_path(path, output_dir)):
+            print('{0}: already digitized, skipped'.format(path))
+        else:
+            todo.append(path)
+
+    results = []
+    failed = []
+
+    def report(path, result):
+        try:
+            result = result()
+        except Exception as error:
+            failed.append((path, error))
+            print('{0}: failed: {1!r}'.format(path, error))
+        else:
+            results.append(result)
+            print(summary_line(result))
+        sys.stdout.flush()
+
+    if workers == 1:
+
+        _init_worker(settings)
+
+        for path in todo:
+            report(path, lambda: digitize_file(path, output_dir, options))
+
+    elif todo:
+
+        with ProcessPoolExecutor(min(workers, len(todo)), initializer = _init_worker, initargs = (settings,)) as executor:
+
+            futures = dict((executor.submit(digitize_file, path, output_dir, options), path) for path in todo)
+
+            for future in as_completed(futures):
+                report(futures[future], future.result)
+
+    return results, failed
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Digitize the atar tree of many simulation files.')
+    parser.add_argument('inputs', nargs = '+', help = 'files, glob patterns or @file lists')
+    parser.add_argument('--spline', required = True, help = 'response file with the pmax_histogram')
+    parser.add_argument('--output-dir', default = '.', help = 'where to write the digitized files')
+    parser.add_argument('--workers', type = int, default = 1, help = 'files digitized at once')
+    parser.add_argument('--overwrite', action = 'store_true', help = 'digitize files whose output already exists')
+    parser.add_argument('--pixel-pitch', type = float, default = 200)
+    parser.add_argument('--pixels-per-plane', type = int, default = 100)
+    parser.add_argument('--n', type = int, default = 2, help = 'strips shared with on either side (-1 to derive it from the spline)')
+    parser.add_argument('--n-planes', type = int, default = None)
+    parser.add_argument('--model', default = 'strip', choices = ['strip', 'slit'])
+    parser.add_argument('--strip-width', type = float, default = 100)
+    parser.add_argument('--threshold', type = float, default = None)
+    parser.add_argument('--suppression', default = 'drop', choices = ['drop', 'renormalize'])
+    parser.add_argument('--merge-window', type = float, default = None)
+    parser.add_argument('--backend', default = 'numpy', choices = ['numpy', 'numba'])
+    parser.add_argument('--compression', default = 'ZSTD', help = 'ZSTD, LZ4, ZLIB, LZMA or none')
+    parser.add_argument('--compression-level', type = int, default = 3)
+    parser.add_argument('--gain-spread', type = float, default = 0., help = 'relative spread of the strip gains')
+    parser.add_argument('--pedestal-noise', type = float, default = 0., help = 'gaussian noise on fragment energies')
+    parser.add_argument('--time-jitter', type = float, default = 0., help = 'gaussian jitter on fragment times')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the smearing')
+    parser.add_argument('--hit-cache', action = 'store_true', help = 'read through a hitcache')
+    parser.add_argument('--step-size', default = '100 MB', help = 'entries or a size such as "100 MB"')
+    parser.add_argument('--keep', nargs = '*', default = [], help = 'trees to pass through')
+    parser.add_argument('--pipeline', action = 'store_true', help = 'overlap reading, computing and writing')
+    parser.add_argument('--checkpoint', action = 'store_true', help = 'save finished chunks so a killed run resumes')
+    args = parser.parse_args()
+
+    settings = {
+        'path_to_spline': args.spline,
+        'pixel_pitch': args.pixel_pitch,
+        'pixels_per_plane': args.pixels_per_plane,
+        'n': None if args.n < 0 else args.n,
+        'n_planes': args.n_planes,
+        'model': args.model,
+        'strip_width': args.strip_width,
+        'threshold': args.threshold,
+        'suppression': args.suppression,
+        'merge_window': args.merge_window,
+        'backend': args.backend,
+        'compression': None if args.compression.lower() == 'none' else args.compression,
+        'compression_level': args.compression_level,
+        'hit_cache': args.hit_cache,
+        'smearing': energy_sharingv3.smearing(args.gain_spread, args.pedestal_noise, args.time_jitter, args.seed) if args.gain_spread or args.pedestal_noise or args.time_jitter else None
+    }
+
+    options = {
+        'step_size': int(args.step_size) if args.step_size.isdigit() else args.step_size,
+        'keep': args.keep,
+        'pipeline': args.pipeline,
+        'checkpoint': args.checkpoint
+    }
+
+    paths = expand_inputs(args.inputs)
+
+    start = time.perf_counter()
+    try:
+        results, failed = run(paths, settings, args.output_dir, options, args.workers, args.overwrite)
+    except ValueError as error:
+        parser.error(str(error))
+
+    print('{0} digitized, {1} skipped, {2} failed in {3:.2f} s'.format(len(results), len(paths) - len(results) - len(failed), len(failed), time.perf_counter() - start))
+
+    sys.exit(1 if failed else 0)
@@ -1,149 +1,1998 @@
-import uproot
-import matplotlib.pyplot as plt
-import hist as Hist
 import numpy as np
 import os 
-import shutil
+import json
+import time
+from collections import deque, OrderedDict
 
+#uproot, awkward, hist and scipy are imported where they are used so that importing the digitizer
+#stays cheap (the digitizer never plots, so matplotlib is not needed at all).
 
-class digitizeatar:
+
+def get_number_of_slits(spline_width, pitch, width):
 
     '''
-        This class computes energy sharing in the Atar. It has methods to build a spline
-        and return atar data with energysharing computed. You must initialized the class
-        with a path to a histogram to build the spline. This spline, once built, can be
-        passed into the compute energysharing method to return updated data. 
+        Based on slit parameters, returns how many other slits an energy 
+        deposit hit can share with on one side assuming the original hit was in
+        center. 
     '''
 
-    #Here is a given path to a spline './BNL_Signal_Response.root'
+    a = spline_width - ((width/2) + pitch)
+    b = width + pitch
+
+    return int(np.floor((a/b) + 1))
+
+
+def get_spline_width(spline):
+
+    '''
+        Returns how far from the hit (in microns) the spline is defined on both sides, i.e. the
+        furthest position energy can be shared to on either side without extrapolating.
+    '''
+
+    return float(np.min(np.abs(spline.x[[0, -1]])))
+
+
+
+#Built splines are cached in process (keyed by path, mtime and histogram name) and on disk as the
+#breakpoints and coefficients of the spline, so a warm build_spline never opens the ROOT file or refits.
+
+spline_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'pioneer', 'splines')
+spline_cache_size = 8
+spline_cache_files = 64
+
+_spline_cache = OrderedDict()
+
+
+def clear_spline_cache(cache_dir = None):
+
+    '''
+        Empties the in process spline cache and removes the cached splines in cache_dir
+        (spline_cache_dir by default).
+    '''
+
+    _spline_cache.clear()
+
+    cache_dir = spline_cache_dir if cache_dir is None else cache_dir
+
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(cache_dir, name))
+
+
+def _evict_spline_files(cache_dir):
+
+    '''
+        Removes the least recently used cached splines beyond spline_cache_files.
+    '''
+
+    paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith('.npz')]
+    paths.sort(key = os.path.getmtime)
+
+    for path in paths[:max(0, len(paths) - spline_cache_files)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+
+#Flattened atar branches can be cached on disk as uncompressed .npy files (content and offsets per branch),
+#keyed by the ROOT file's UUID, size and modification time, and memory mapped by later runs.
+
+hit_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'pioneer', 'hits')
+
+
+def clear_hit_cache(cache_dir = None):
+
+    '''
+        Removes the cached atar branches in cache_dir (hit_cache_dir by default).
+    '''
+
+    import shutil
+
+    cache_dir = hit_cache_dir if cache_dir is None else cache_dir
+
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors = True)
+
+
+class hitcache:
+
+    '''
+        Uncompressed columnar copy of the jagged branches of a tree. Every branch is stored as
+        <branch>.npy (its flat content) and <branch>.offsets.npy (int64, num_entries + 1) in a
+        directory of cache_dir named after the file's UUID, size and modification time, the tree
+        and the branches. The first use decompresses the tree once (in chunks of step_size) into a
+        temporary directory that is renamed when complete, taking the counts from the data since
+        std::vector branches have no counter branch; afterwards the arrays are memory mapped, so
+        reads neither copy nor decompress. Pickling keeps only the path, so worker processes map
+        the files themselves.
+    '''
+
+    def __init__(self, tree, branches, cache_dir = None, step_size = "100 MB"):
+
+        import hashlib
+
+        cache_dir = hit_cache_dir if cache_dir is None else cache_dir
+
+        stat = os.stat(tree.file.file_path)
+        key = (tree.file.uuid, stat.st_size, stat.st_mtime_ns, tree.object_path, tuple(branches))
+
+        self.path = os.path.join(cache_dir, hashlib.sha1(repr(key).encode()).hexdigest())
+        self.branches = list(branches)
+
+        if not os.path.isdir(self.path):
+            self._build(tree, step_size)
+
+        self._map()
+
+
+    def _build(self, tree, step_size):
+
+        import uuid
+        import shutil
+        import awkward as ak
+
+        tmp = '{0}.{1}.tmp'.format(self.path, uuid.uuid4().hex)
+        os.makedirs(tmp)
+
+        #The production pixel_* branches are std::vectors without counter branches, so the counts come from the
+        #data: one pass appends the content of every chunk to a raw file, which gets its .npy header at the end
+
+        dtypes = dict((name, ak.to_numpy(ak.flatten(array)).dtype) for name, array in zip(self.branches, ak.unzip(tree.arrays(self.branches, entry_stop = 0))))
+        counts = dict((name, []) for name in self.branches)
+        raw = dict((name, open(os.path.join(tmp, name + '.raw'), 'wb')) for name in self.branches)
+
+        try:
+            for data in tree.iterate(self.branches, step_size = step_size):
+                for name in self.branches:
+                    counts[name].append(ak.to_numpy(ak.num(data[name])))
+                    raw[name].write(ak.to_numpy(ak.flatten(data[name])).astype(dtypes[name], copy = False).tobytes())
+        finally:
+            for f in raw.values():
+                f.close()
+
+        for name in self.branches:
+
+            offsets = np.zeros(sum(len(part) for part in counts[name]) + 1, dtype = np.int64)
+            np.cumsum(np.concatenate(counts[name] + [np.zeros(0, np.int64)]), out = offsets[1:])
+            np.save(os.path.join(tmp, name + '.offsets.npy'), offsets)
+
+            header = {'descr': np.lib.format.dtype_to_descr(dtypes[name]), 'fortran_order': False, 'shape': (int(offsets[-1]),)}
+
+            with open(os.path.join(tmp, name + '.npy'), 'wb') as f, open(os.path.join(tmp, name + '.raw'), 'rb') as content:
+                np.lib.format.write_array_header_1_0(f, header)
+                shutil.copyfileobj(content, f, 16 << 20)
+
+            os.remove(os.path.join(tmp, name + '.raw'))
+
+        try:
+            os.rename(tmp, self.path)
+        except OSError:
+
+            #Another process finished the same cache first
+
+            shutil.rmtree(tmp, ignore_errors = True)
+
+
+    def _map(self):
+
+        self.contents = dict((name, np.load(os.path.join(self.path, name + '.npy'), mmap_mode = 'r')) for name in self.branches)
+        self.offsets = dict((name, np.load(os.path.join(self.path, name + '.offsets.npy'), mmap_mode = 'r')) for name in self.branches)
+
+
+    def __getstate__(self):
+        return {'path': self.path, 'branches': self.branches}
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._map()
+
+
+    @property
+    def num_entries(self):
+        return len(self.offsets[self.branches[0]]) - 1
+
+
+    def arrays(self, entry_start, entry_stop):
 
-    def __init__(self, path_to_spline, pixel_pitch = 200, pixels_per_plane = 100):
-        
         '''
-        Energysharing spline path must be provided by the user. There are given values for pixel pitch and pixels per plane (strips per plane) 
-        based on current simulation parameters. These can be changed. 
+            The entries entry_start to entry_stop as an awkward record array viewing the mapped files.
         '''
-        self.path_to_spline =  path_to_spline
-        self.pixel_pitch = pixel_pitch
+
+        import awkward as ak
+
+        fields = {}
+
+        for name in self.branches:
+            offsets = ak.index.Index64(self.offsets[name][entry_start:entry_stop + 1])
+            fields[name] = ak.contents.ListOffsetArray(offsets, ak.contents.NumpyArray(self.contents[name]))
+
+        return ak.Array(ak.contents.RecordArray(list(fields.values()), list(fields), length = entry_stop - entry_start))
+
+
+    def read(self, runs):
+
+        '''
+            Reads the (entry_start, entry_stop, local) runs of a task, like _read_runs does from the tree.
+        '''
+
+        import awkward as ak
+
+        parts = [self.arrays(entry_start, entry_stop) if local is None else self.arrays(entry_start, entry_stop)[local] for entry_start, entry_stop, local in runs]
+
+        return parts[0] if len(parts) == 1 else ak.concatenate(parts)
+
+
+
+class atargeometry:
+
+    '''
+        Strip layout of the atar with a dense neighbour table. Planes are blocks of pixels_per_plane
+        strips numbered like get_adjacent_strips does (strip s is in plane ceil(s / pixels_per_plane)) and
+        the table covers strips 0 to n_planes * pixels_per_plane. Row s holds the 2n+1 candidate neighbours
+        of strip s (int32), a mask of the ones in the same plane and the index of its edge truncation
+        pattern, so whole hit arrays are looked up with one indexing operation.
+
+        Two models place the neighbours for the spline: 'strip' puts offset i at i * pixel_pitch, 'slit'
+        puts them at the slit positions of adjacent_slits in the v2 prototype (slits of strip_width separated
+        by pixel_pitch). If n is not given it is derived from spline_width.
+    '''
+
+    def __init__(self, pixels_per_plane = 100, n_planes = 1, pixel_pitch = 200, n = None, spline_width = None, model = 'strip', strip_width = 100):
+
+        if model not in ('strip', 'slit'):
+            raise ValueError("model must be 'strip' or 'slit', not {0!r}".format(model))
+
+        if n is None:
+            if spline_width is None:
+                raise ValueError('either n or spline_width must be given')
+
+            if model == 'slit':
+                n = get_number_of_slits(spline_width, pixel_pitch, strip_width)
+            else:
+                n = int(spline_width // pixel_pitch)
+
         self.pixels_per_plane = pixels_per_plane
+        self.n_planes = n_planes
+        self.pixel_pitch = pixel_pitch
+        self.n = n = max(n, 0)
+        self.model = model
+        self.strip_width = strip_width
 
+        #Position of every offset for the spline
 
+        offsets = np.arange(-n, n + 1)
 
-    #For the paramaters in the atar simulation, the number of slits accessible on either side is two.
+        if model == 'slit':
+            period = pixel_pitch + strip_width
+            self.positions = (offsets * period).astype(float)
+            if n > 0:
+                self.positions[[0, -1]] = np.array([-1, 1]) * ((n - 1) * period + pixel_pitch + strip_width/2)
+        else:
+            self.positions = (offsets * pixel_pitch).astype(float)
+
+        #Dense neighbour table. A plane holds strips (k - 1) * pixels_per_plane + 1 to k * pixels_per_plane,
+        #so local is the position of a strip in its plane.
+
+        strips = np.arange(n_planes * pixels_per_plane + 1)
+        local = (strips - 1) % pixels_per_plane
+        left = np.minimum(local, n)
+        right = np.minimum(pixels_per_plane - 1 - local, n)
+
+        self.neighbours = (strips[:, None] + offsets).astype(np.int32)
+        self.valid = (offsets >= -left[:, None]) & (offsets <= right[:, None])
+        self.pattern = (left * (n + 1) + right).astype(np.int32)
+
+        #Offsets kept by every edge truncation pattern, rows indexed like self.pattern
+
+        pattern_left, pattern_right = np.divmod(np.arange((n + 1) ** 2), n + 1)
+
+        self.pattern_valid = (offsets >= -pattern_left[:, None]) & (offsets <= pattern_right[:, None])
+
+        self._weight_table = None
+        self._weight_table_spline = None
 
-    def get_adjacent_strips(self, pixel, n = 2):
+
+    @property
+    def n_strips(self):
+        return len(self.neighbours)
+
+
+    def rows(self, strips):
         '''
-        Returns n adjacent strips within the same plane from a given strip (pixel). 
-        N is determined by the spline width and can be adjusted as necessary. 
-        Assumed pixel pitch of 200 microns and a spline width of 600 microns.
+        Returns the table rows of an array of strips, checking they are covered by the geometry.
         '''
-        return [(pixel + x) for x in range(-n, n+1) if int(np.ceil(float((pixel + x)/self.pixels_per_plane))) == int(np.ceil(float(pixel)/self.pixels_per_plane))]
-        
+        strips = np.asarray(strips)
+
+        if len(strips) and (strips.min() < 0 or strips.max() >= self.n_strips):
+            raise ValueError('strips must be between 0 and {0}, got {1} to {2}'.format(self.n_strips - 1, strips.min(), strips.max()))
 
+        return strips
 
-    def build_spline(self):
+
+    def weight_table(self, spline):
         '''
-            Builds a cubic spline to interpolate the energy sharing
-            distribution histogram. Has a default spline if no other data is given.
+        Returns the energy sharing fractions for the 2n+1 offsets, already normalized, for every edge
+        truncation pattern (indexed like self.pattern). Built once per spline.
         '''
 
-        with uproot.open(self.path_to_spline) as f:
+        if self._weight_table_spline is not spline:
 
-            h = f['pmax_histogram'].to_hist()
+            #The spline only ever sees these 2n+1 positions
 
+            weights = np.where(self.pattern_valid, spline(self.positions), 0)
 
-            from scipy.interpolate import UnivariateSpline, CubicSpline
+            self._weight_table = weights / np.sum(weights, axis = 1)[:, None]
+            self._weight_table_spline = spline
 
-            centers = h.axes.centers[0]
-            
-            amps = h.values()/np.amax(h.values())
+        return self._weight_table
 
-            spline = CubicSpline(centers, amps, extrapolate = False)
 
-        return spline
 
+#Random numbers for smearing come from a counter based generator: a splitmix64 style hash of the seed, a
+#stream number and integer keys, so every draw depends only on what it is for and not on chunking or workers.
+
+_golden = np.uint64(0x9e3779b97f4a7c15)
+
+
+def _mix(z):
+
+    '''
+        splitmix64 finalizer on a uint64 array.
+    '''
+
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+
+    return z ^ (z >> np.uint64(31))
+
+
+def counter_normal(seed, stream, *keys):
+
+    '''
+        Standard normal draws, one per element of the broadcast integer key arrays, from a hash of
+        (seed, stream, *keys) and the Box-Muller transform. The same keys always give the same draws.
+    '''
+
+    keys = np.broadcast_arrays(*[np.asarray(key).astype(np.uint64) for key in keys])
+
+    uniforms = []
+
+    for half in (0, 1):
+
+        z = _mix(np.full(keys[0].shape, seed, dtype = np.uint64) * _golden + np.uint64(2 * stream + half))
+
+        for key in keys:
+            z = _mix(z ^ (key + _golden))
+
+        uniforms.append(((z >> np.uint64(11)).astype(np.float64) + 1) * 2. ** -53)
+
+    return np.sqrt(-2 * np.log(uniforms[0])) * np.cos(2 * np.pi * uniforms[1])
+
+
+def file_key(root_file):
+
+    '''
+        Integer key of a ROOT file (a path or an open uproot file) for smearing streams: a hash of its UUID,
+        so copies of a file smear alike.
+    '''
+
+    import zlib
+    import uproot
+
+    if isinstance(root_file, str):
+        with uproot.open(root_file) as f:
+            return file_key(f)
+
+    return zlib.crc32(str(root_file.file.uuid).encode())
 
-    def compute_energy_sharing(self, root_path, spline, entry = "All"):
 
+
+class smearing:
+
+    '''
+        Electronics response applied to digitized fragments: a fixed relative gain per strip (spread gain_spread),
+        gaussian pedestal noise on every fragment energy (pedestal_noise, pixel_edep units) and gaussian time
+        jitter (time_jitter, pixel_time units). The gain of a strip is drawn from (seed, strip) and the noise and
+        jitter of a fragment from (seed, file key, entry, fragment index in the entry), with counter_normal, so
+        results are bit identical for any chunking and number of workers. All draws of a chunk are vectorized.
+    '''
+
+    def __init__(self, gain_spread = 0., pedestal_noise = 0., time_jitter = 0., seed = 0):
+
+        self.gain_spread = gain_spread
+        self.pedestal_noise = pedestal_noise
+        self.time_jitter = time_jitter
+        self.seed = seed
+
+
+    def __repr__(self):
+        return 'smearing(gain_spread = {0!r}, pedestal_noise = {1!r}, time_jitter = {2!r}, seed = {3!r})'.format(self.gain_spread, self.pedestal_noise, self.time_jitter, self.seed)
+
+
+    def gains(self, strips):
         '''
-        Returns a root file in the current working directory of the form 'digitized <root_path>'. 
-        Must be called with a path to the root file you want to digitize and a spline for energy sharing. The new
-        root file has a digitized atar branch with energy sharing data computed. If no event is specified, it will compute energy sharing for all entries. 
-        TODO: delete old atar branch and copy over relevant data to new file. 
+        Relative gain of every strip.
         '''
+        return 1 + self.gain_spread * counter_normal(self.seed, 0, strips)
 
-        dest = os.getcwd() + '/digitized' + os.path.basename(root_path)
 
-        shutil.copy(root_path, dest)
+    def apply(self, per_event, strips, energies, times, entries, key = 0):
+
+        '''
+            Smeared copies of flat fragment energies and times (same dtypes) given the number of fragments of each
+            event and the entry numbers of the events.
+        '''
 
+        per_event = np.asarray(per_event)
 
-        
-        #TTree of updated data
+        fragment_entries = np.repeat(np.asarray(entries), per_event)
+        index = np.arange(len(strips)) - np.repeat(np.cumsum(per_event) - per_event, per_event)
 
-        tree = {
-            'pixel_pdg':[],
-            'pixel_edep':[],
-            'pixel_time':[],
-            'pixel_hits':[]
-        }
+        energies_out = energies.astype(np.float64)
+        times_out = times
 
-        
-        with uproot.open(root_path + ':atar') as infile:
+        if self.gain_spread:
+            energies_out = energies_out * self.gains(strips)
+
+        if self.pedestal_noise:
+            energies_out = energies_out + self.pedestal_noise * counter_normal(self.seed, 1, key, fragment_entries, index)
+
+        if self.time_jitter:
+            times_out = times.astype(np.float64) + self.time_jitter * counter_normal(self.seed, 2, key, fragment_entries, index)
+
+        return energies_out.astype(energies.dtype), np.asarray(times_out).astype(times.dtype)
+
+
+
+class digitizerstats:
+
+    '''
+        Counters and timers for digitizeatar runs. Pass one to digitizeatar(stats = ...) to find out
+        where the time goes: seconds spent reading (and decompressing) the atar tree, computing the
+        sharing, writing the output and building splines, plus counts of events, hits, fragments, chunks,
+        spline builds and cache hits, compressed bytes read and bytes written. With workers > 1 read and
+        compute are summed over the workers. callback(stats) is called after every chunk and at the
+        end of every run, and if path is given the totals and a summary per run are dumped there as JSON
+        after every run. A digitizeatar without stats skips all of this.
+    '''
+
+    def __init__(self, callback = None, path = None):
+
+        self.callback = callback
+        self.path = path
+
+        self.seconds = {'read': 0., 'compute': 0., 'write': 0., 'spline': 0., 'total': 0.}
+        self.counts = {'events': 0, 'hits': 0, 'fragments': 0, 'chunks': 0, 'bytes_read': 0, 'bytes_written': 0,
+                       'spline_builds': 0, 'spline_disk_hits': 0, 'spline_memory_hits': 0}
+        self.runs = []
+
+
+    def timer(self, stage):
+        '''
+        Context manager adding the time spent in its block to stage.
+        '''
+        return _stagetimer(self.seconds, stage)
 
-            data = infile.arrays(['pixel_pdg', 'pixel_edep', 'pixel_time', 'pixel_hits'])
-            pdg = data['pixel_pdg']
-            edep = data['pixel_edep']
-            time = data['pixel_time']
-            hits = data['pixel_hits']
+
+    def add_chunk(self, events, hits, fragments, bytes_read, seconds = None):
+        '''
+        Records a digitized chunk, optionally with read and compute seconds measured elsewhere (in a worker).
+        '''
+        self.counts['events'] += events
+        self.counts['hits'] += hits
+        self.counts['fragments'] += fragments
+        self.counts['bytes_read'] += bytes_read
+        self.counts['chunks'] += 1
+
+        for stage, spent in (seconds or {}).items():
+            self.seconds[stage] += spent
+
+        if self.callback is not None:
+            self.callback(self)
+
+
+    def add_spline(self, source, seconds):
+        '''
+        Records a build_spline call answered by source ('builds', 'disk_hits' or 'memory_hits').
+        '''
+        self.counts['spline_' + source] += 1
+        self.seconds['spline'] += seconds
+
+
+    def add_run(self, root_path, dest, seconds, before):
+        '''
+        Records the end of a compute_energy_sharing run, given the counts from before it started.
+        '''
+        self.seconds['total'] += seconds
+        self.counts['bytes_written'] += os.path.getsize(dest)
+
+        run = dict((name, self.counts[name] - before[name]) for name in ('events', 'hits', 'fragments', 'bytes_read', 'bytes_written'))
+        run.update(input = root_path, output = dest, seconds = seconds, events_per_s = run['events'] / seconds if seconds else 0., hits_per_s = run['hits'] / seconds if seconds else 0.)
+
+        self.runs.append(run)
+
+        if self.callback is not None:
+            self.callback(self)
+
+        if self.path is not None:
+            self.dump(self.path)
+
+
+    def as_dict(self):
+        return {'seconds': dict(self.seconds), 'counts': dict(self.counts), 'runs': list(self.runs)}
+
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent = 2)
+
+
+    def __repr__(self):
+        return 'digitizerstats(seconds = {0}, counts = {1})'.format(self.seconds, self.counts)
+
+
+
+class _stagetimer:
+
+    '''
+        Adds the time spent in a with block to seconds[stage].
+    '''
+
+    def __init__(self, seconds, stage):
+        self.seconds = seconds
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.seconds[self.stage] += time.perf_counter() - self.start
+
+
+
+class _nostats:
+
+    '''
+        Stand in for a digitizerstats when instrumentation is off: timers do nothing.
+    '''
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+    def timer(self, stage):
+        return self
+
+
+_nostats = _nostats()
+
+
+
+class digitizeatar:
+
+    '''
+        This class computes energy sharing in the Atar. It has methods to build a spline
+        and return atar data with energysharing computed. You must initialized the class
+        with a path to a histogram to build the spline. This spline, once built, can be
+        passed into the compute energysharing method to return updated data. 
+    '''
+
+    #Branches read from the atar tree
+
+    atar_branches = ['pixel_pdg', 'pixel_edep', 'pixel_time', 'pixel_hits']
+
+    #Default dtypes of the digitized_atar branches (override with dtypes). Strip numbers and pdg codes fit in int32
+    #(int16 holds strips up to 32767 and the pdg codes of leptons, pions and nucleons, not nuclei such as 1000020040;
+    #values that do not fit raise an OverflowError). float32 keeps 24 bits of mantissa, a relative precision of 6e-8,
+    #which is far below any energy resolution, so edep is stored as float32. For times it means 1 ps at 10 us, still
+    #float64 by default for long decay chains and pile-up studies. The kernel always computes in float64.
+
+    output_dtypes = {
+        'pixel_pdg': 'int32',
+        'pixel_edep': 'float32',
+        'pixel_time': 'float64',
+        'pixel_hits': 'int32',
+        'suppressed_edep': 'float32'
+    }
+
+
+    #Here is a given path to a spline './BNL_Signal_Response.root'
+
+    def __init__(self, path_to_spline, pixel_pitch = 200, pixels_per_plane = 100, n = 2, n_planes = None, model = 'strip', strip_width = 100, spline_cache_dir = None, backend = 'numpy', stats = None, dtypes = None, compression = 'ZSTD', compression_level = 3, basket_size = None, threshold = None, suppression = 'drop', merge_window = None, hit_cache = False, hit_cache_dir = None, smearing = None):
         
-            if entry != 'All':
-                pdg = [data['pixel_pdg'][entry]]
-                edep = [data['pixel_edep'][entry]]
-                time = [data['pixel_time'][entry]]
-                hits = [data['pixel_hits'][entry]]
-    
-            for ent, event in enumerate(hits):
-                #Go over all events 
-                edep_list = []
-                hits_list = []
-                time_list = []
-                pdg_list = []
-                    
-                for i, hiti in enumerate(event):
-                    #Loop over all hits for each event and calculate energy sharing
-
-                    these_energies = []
-                    
-                    for j, pos in enumerate(self.get_adjacent_strips(hiti)):
-                        energy_position = (pos - hiti) * self.pixel_pitch
-                        energyi = spline(energy_position)*edep[ent][i]
-                        these_energies.append(energyi)
-                    
-                    #Normalize the energies to conserve energy
-                    these_energies = np.array(these_energies) * (edep[ent][i]/np.sum(these_energies))
-
-                    # print("total Energy", np.sum(these_energies), edep[i])
-
-                    edep_list += list(these_energies)
-                    hits_list += self.get_adjacent_strips(hiti)
-                    time_list += list(np.full_like(these_energies, time[ent][i]))
-                    pdg_list += list(np.full_like(these_energies, pdg[ent][i], dtype=int))
-                
-                #Add the updated data to the new tree branches
+        '''
+        Energysharing spline path must be provided by the user. There are given values for pixel pitch, pixels per plane (strips per plane)
+        and the number of strips shared with on either side based on current simulation parameters. These can be changed. 
+        With n = None the number of strips is derived from the spline width (see atargeometry). The geometry covers
+        n_planes planes, or as many as the hits need if not given. model and strip_width select the atargeometry model.
+        Built splines are cached on disk in spline_cache_dir (the module level spline_cache_dir if not given).
+        backend = 'numba' uses a compiled sharing kernel, falling back to numpy (with a warning) if Numba is not installed.
+        stats is an optional digitizerstats collecting per stage timings and throughput.
+        The output is written with the branch dtypes of output_dtypes, updated with dtypes, and compressed with
+        compression ('ZSTD', 'LZ4', 'ZLIB', 'LZMA', None or an uproot compression object) at compression_level.
+        ZSTD level 3 writes compact files several times faster than uproot's default ZLIB(1). basket_size is the
+        number of entries per basket (one basket per chunk if None).
+        With a threshold (same units as pixel_edep) strip fragments below it are zero suppressed: suppression = 'drop'
+        loses their energy, 'renormalize' shares it over the surviving strips of the hit. The energy each event loses
+        is written to a suppressed_edep branch.
+        With a merge_window (same units as pixel_time) the fragments of an event that land on the same strip within
+        merge_window of each other are merged into one, see merge_strip_fragments.
+        With hit_cache = True the atar branches are read through a hitcache in hit_cache_dir (the module level
+        hit_cache_dir if not given): the first run decompresses them once into memory mappable files and later runs
+        on the same file, with any spline or geometry, map those instead of reading the ROOT baskets.
+        smearing is an optional smearing (gain, pedestal noise and time jitter) applied to the fragments after sharing.
+        '''
+
+        if backend not in ('numpy', 'numba'):
+            raise ValueError("backend must be 'numpy' or 'numba', not {0!r}".format(backend))
+
+        if suppression not in ('drop', 'renormalize'):
+            raise ValueError("suppression must be 'drop' or 'renormalize', not {0!r}".format(suppression))
+
+        self.path_to_spline =  path_to_spline
+        self.pixel_pitch = pixel_pitch
+        self.pixels_per_plane = pixels_per_plane
+        self.n = n
+        self.n_planes = n_planes
+        self.model = model
+        self.strip_width = strip_width
+        self.spline_cache_dir = spline_cache_dir
+        self.backend = backend
+        self.stats = stats
+        self.dtypes = dict(self.output_dtypes, **(dtypes or {}))
+        self.compression = compression
+        self.compression_level = compression_level
+        self.basket_size = basket_size
+        self.threshold = threshold
+        self.suppression = suppression
+        self.merge_window = merge_window
+        self.hit_cache = hit_cache
+        self.hit_cache_dir = hit_cache_dir
+        self.smearing = smearing
+
+        self._geometry = None
+        self._geometry_key = None
+
+
+
+    @property
+    def branch_types(self):
+        '''
+        Branch types of the digitized_atar TTree.
+        '''
+        types = dict((name, 'var * ' + np.dtype(self.dtypes[name]).name) for name in self.atar_branches)
+
+        if self.threshold is not None:
+            types['suppressed_edep'] = np.dtype(self.dtypes['suppressed_edep']).name
+
+        return types
+
+
+    def output_compression(self):
+        '''
+        Returns the uproot compression setting for the output file.
+        '''
+        import uproot
+
+        if self.compression is None or isinstance(self.compression, str) and self.compression.upper() == 'NONE':
+            return None
+
+        if isinstance(self.compression, str):
+            return getattr(uproot, self.compression.upper())(self.compression_level)
+
+        return self.compression
+
+
+
+    #For the paramaters in the atar simulation, the number of slits accessible on either side is two.
+
+    def get_adjacent_strips(self, pixel, n = None):
+        '''
+        Returns n adjacent strips within the same plane from a given strip (pixel). 
+        N is determined by the spline width and can be adjusted as necessary (defaults to self.n). 
+        Assumed pixel pitch of 200 microns and a spline width of 600 microns.
+        '''
+        if n is None:
+            n = self.n if self.n is not None else self.geometry(self.build_spline()).n
+
+        return [(pixel + x) for x in range(-n, n+1) if int(np.ceil(float((pixel + x)/self.pixels_per_plane))) == int(np.ceil(float(pixel)/self.pixels_per_plane))]
+        
+
+
+    def build_spline(self, histogram = 'pmax_histogram', cache = True):
+        '''
+            Builds a cubic spline to interpolate the energy sharing
+            distribution histogram. Has a default spline if no other data is given.
+            Splines are cached in process and in self.spline_cache_dir; the cache is keyed by the
+            path, modification time and size of the file and the histogram name, so editing the file
+            invalidates it. Pass cache = False to always rebuild.
+        '''
+
+        import hashlib
+        import zipfile
+        from scipy.interpolate import CubicSpline
+
+        start = time.perf_counter()
+
+        stat = os.stat(self.path_to_spline)
+        key = (os.path.abspath(self.path_to_spline), stat.st_mtime_ns, stat.st_size, histogram)
+
+        if cache and key in _spline_cache:
+            _spline_cache.move_to_end(key)
+
+            if self.stats is not None:
+                self.stats.add_spline('memory_hits', time.perf_counter() - start)
+
+            return _spline_cache[key]
+
+        cache_dir = spline_cache_dir if self.spline_cache_dir is None else self.spline_cache_dir
+        cache_path = os.path.join(cache_dir, hashlib.sha1(repr(key).encode()).hexdigest() + '.npz')
+
+        spline = None
+
+        if cache and os.path.exists(cache_path):
+
+            #A truncated or unreadable cache file is dropped (when we may) and the spline rebuilt
+
+            try:
+                with np.load(cache_path) as cached:
+                    spline = CubicSpline.construct_fast(cached['c'], cached['x'], extrapolate = False)
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+                try:
+                    os.remove(cache_path)
+                except OSError:
+                    pass
+
+            #Refreshing the mtime only feeds the eviction order, a shared read-only cache is fine without it
+
+            if spline is not None:
+                try:
+                    os.utime(cache_path)
+                except OSError:
+                    pass
+
+            source = 'disk_hits'
+
+        if spline is None:
+
+            source = 'builds'
+
+            import uproot
+
+            with uproot.open(self.path_to_spline) as f:
+
+                h = f[histogram].to_hist()
+
+                centers = h.axes.centers[0]
+                
+                amps = h.values()/np.amax(h.values())
+
+                spline = CubicSpline(centers, amps, extrapolate = False)
+
+            if cache:
+
+                #The disk cache is best effort, an unwritable cache directory only costs the rebuild
+
+                try:
+                    os.makedirs(cache_dir, exist_ok = True)
+                    np.savez(cache_path + '.tmp.npz', x = spline.x, c = spline.c)
+                    os.replace(cache_path + '.tmp.npz', cache_path)
+                    _evict_spline_files(cache_dir)
+                except OSError:
+                    pass
+
+        if cache:
+            _spline_cache[key] = spline
+
+            while len(_spline_cache) > spline_cache_size:
+                _spline_cache.popitem(last = False)
+
+        if self.stats is not None:
+            self.stats.add_spline(source, time.perf_counter() - start)
+
+        return spline
+
+
+    def geometry(self, spline, max_strip = 0):
+        '''
+        Returns the atargeometry for the current parameters, covering at least strips up to max_strip.
+        It is rebuilt (together with its weight table) when pixel_pitch, pixels_per_plane, n, the model
+        or, if n is derived from it, the spline change.
+        '''
+
+        n_planes = self.n_planes or max(1, -(-int(max_strip) // self.pixels_per_plane))
+        spline_width = get_spline_width(spline) if self.n is None else None
+
+        key = (self.pixel_pitch, self.pixels_per_plane, self.n, spline_width, self.model, self.strip_width)
+
+        if self._geometry_key != key or self._geometry.n_strips <= max_strip:
+
+            if self._geometry_key == key:
+                n_planes = max(n_planes, self._geometry.n_planes)
+
+            self._geometry = atargeometry(self.pixels_per_plane, n_planes, self.pixel_pitch, self.n, spline_width, self.model, self.strip_width)
+            self._geometry_key = key
+
+        return self._geometry
+
+
+    def digitize(self, events, spline = None, entries = None, key = 0):
+        '''
+        Digitizes events in memory. events is an awkward record array (or a dict of jagged arrays) with the pixel_hits,
+        pixel_edep, pixel_time and pixel_pdg fields of the atar tree; other fields are ignored. Returns an awkward record
+        array with one entry per event and the fields of the digitized_atar tree (see share_energy), ready to be
+        selected and histogrammed. Nothing is read or written apart from building the spline (through the spline
+        cache) when none is given. compute_energy_sharing applies this to a file chunk by chunk.
+        With a smearing, entries (the entry numbers of the events, 0 to len(events) - 1 by default) and key (see
+        file_key) select its random streams.
+        '''
+
+        import awkward as ak
+
+        if spline is None:
+            spline = self.build_spline()
+
+        fragments = self.share_energy(events['pixel_hits'], events['pixel_edep'], events['pixel_time'], events['pixel_pdg'], spline)
+
+        if self.smearing is not None:
+
+            per_event = ak.to_numpy(ak.num(fragments['pixel_hits']))
+            entries = np.arange(len(per_event)) if entries is None else entries
+
+            energies, times = self.smearing.apply(per_event, ak.to_numpy(ak.flatten(fragments['pixel_hits'])), ak.to_numpy(ak.flatten(fragments['pixel_edep'])),
+                                                  ak.to_numpy(ak.flatten(fragments['pixel_time'])), entries, key)
+
+            fragments['pixel_edep'] = ak.unflatten(energies, per_event)
+            fragments['pixel_time'] = ak.unflatten(times, per_event)
+
+        return ak.zip(fragments, depth_limit = 1)
+
+
+    def share_energy(self, hits, edep, time, pdg, spline):
+        '''
+        Computes energy sharing for jagged (per event) atar hit arrays without looping in python.
+        The neighbours of every hit come from the atargeometry table and its edge pattern picks a row of
+        the weight table, so sharing is a table gather and a multiply by the deposited energy.
+        Returns a dict of jagged arrays holding the same fragments, in the same order, as the per-hit
+        loop (energies agree with it to rounding), in the dtypes of self.dtypes. With a threshold, fragments below it
+        are never materialized and the dict also holds the suppressed_edep of every event. With a merge_window the
+        fragments of each event are then merged per strip (see merge_strip_fragments). With backend = 'numba'
+        the fragments are written by compiled kernels straight into preallocated output arrays, in parallel over events.
+        '''
+
+        import awkward as ak
+
+        counts = ak.to_numpy(ak.num(hits))
+
+        flat_hits = ak.to_numpy(ak.flatten(hits))
+        flat_edep = ak.to_numpy(ak.flatten(edep))
+        flat_time = ak.to_numpy(ak.flatten(time))
+        flat_pdg = ak.to_numpy(ak.flatten(pdg))
+
+        geometry = self.geometry(spline, np.max(flat_hits, initial = 0))
+        weights = geometry.weight_table(spline)
+
+        #One lookup in the neighbour table for all hits
+
+        rows = geometry.rows(flat_hits)
+        per_hit = np.count_nonzero(geometry.pattern_valid, axis = 1)[geometry.pattern[rows]]
+
+        #Fragments per event, to unflatten back into the event structure
+
+        hit_offsets = np.concatenate([[0], np.cumsum(counts)])
+        fragment_offsets = np.concatenate([[0], np.cumsum(per_hit)])
+        per_event = fragment_offsets[hit_offsets[1:]] - fragment_offsets[hit_offsets[:-1]]
+
+        dtypes = self.dtypes
+
+        _check_fits(flat_hits, dtypes['pixel_hits'], 'pixel_hits', geometry.n)
+        _check_fits(flat_pdg, dtypes['pixel_pdg'], 'pixel_pdg')
+
+        suppress = self.threshold is not None
+        renormalize = self.suppression == 'renormalize'
+
+        kernels = _numba_kernels() if self.backend == 'numba' else None
+
+        if kernels is not None:
+
+            scale = np.ones(len(flat_hits))
+            lost = np.zeros(len(counts))
+
+            #Count the fragments that survive the threshold first, so only those are written
+
+            if suppress:
+                kernels['suppress'](hit_offsets, flat_hits, flat_edep, geometry.pattern, geometry.pattern_valid, weights, geometry.n, self.threshold, renormalize, per_hit, scale, lost)
+
+                fragment_offsets = np.concatenate([[0], np.cumsum(per_hit)])
+                per_event = fragment_offsets[hit_offsets[1:]] - fragment_offsets[hit_offsets[:-1]]
+
+            strips = np.empty(fragment_offsets[-1], dtype = dtypes['pixel_hits'])
+            energies = np.empty(fragment_offsets[-1], dtype = dtypes['pixel_edep'])
+            times = np.empty(fragment_offsets[-1], dtype = dtypes['pixel_time'])
+            pdgs = np.empty(fragment_offsets[-1], dtype = dtypes['pixel_pdg'])
+
+            kernels['share'](hit_offsets, fragment_offsets, flat_hits, flat_edep, flat_time, flat_pdg, geometry.pattern, geometry.pattern_valid, weights, geometry.n,
+                             suppress, self.threshold if suppress else 0., renormalize, scale, strips, energies, times, pdgs)
+
+        else:
+
+            same_plane = geometry.valid[rows]
+            hit_index = np.nonzero(same_plane)[0]
+
+            strips = geometry.neighbours[rows][same_plane]
+            energies = weights[geometry.pattern[rows]][same_plane] * flat_edep[hit_index]
+
+            if suppress:
+
+                #Zero suppression: fragments below threshold are dropped, their energy is either lost
+                #or put back on the surviving strips of the same hit (lost only if none survives)
+
+                keep = energies >= self.threshold
+                event_of_hit = np.repeat(np.arange(len(counts)), counts)
+
+                if renormalize:
+                    kept = np.bincount(hit_index[keep], energies[keep], minlength = len(flat_hits))
+                    scale = np.divide(flat_edep, kept, out = np.zeros(len(flat_hits)), where = kept != 0)
+                    lost = np.bincount(event_of_hit, np.where(kept != 0, 0., flat_edep), minlength = len(counts))
+                    energies = energies[keep] * scale[hit_index[keep]]
+                else:
+                    lost = np.bincount(event_of_hit[hit_index[~keep]], energies[~keep], minlength = len(counts))
+                    energies = energies[keep]
+
+                hit_index = hit_index[keep]
+                strips = strips[keep]
+                per_event = np.bincount(event_of_hit[hit_index], minlength = len(counts))
+
+            strips = strips.astype(dtypes['pixel_hits'])
+            energies = energies.astype(dtypes['pixel_edep'])
+            times = flat_time[hit_index].astype(dtypes['pixel_time'])
+            pdgs = flat_pdg[hit_index].astype(dtypes['pixel_pdg'])
+
+        if self.merge_window is not None:
+            strips, energies, times, pdgs, per_event = merge_strip_fragments(per_event, strips, energies, times, pdgs, self.merge_window)
+
+        fragments = {
+            'pixel_pdg': ak.unflatten(pdgs, per_event),
+            'pixel_edep': ak.unflatten(energies, per_event),
+            'pixel_time': ak.unflatten(times, per_event),
+            'pixel_hits': ak.unflatten(strips, per_event)
+        }
+
+        if suppress:
+            fragments['suppressed_edep'] = lost.astype(dtypes['suppressed_edep'])
+
+        return fragments
+
+
+    def entry_tasks(self, atar, entry = "All", step_size = "100 MB", workers = 1):
+
+        '''
+        Splits an entry selection of the atar tree into tasks, each a list of (entry_start, entry_stop, local)
+        runs to read, holding about step_size entries (a number of entries or a size such as "100 MB"; with
+        workers > 1 small enough that every worker gets several tasks). entry is "All", an int, a slice, an
+        array of entry numbers or a boolean mask. Contiguous selections become plain entry_start/entry_stop
+        ranges. Scattered ones are grouped by the basket clusters of the tree and read as the span of the
+        selected entries in each cluster, with local the positions to keep, so only the baskets holding
+        selected entries are read. Tasks are in selection order.
+        '''
+
+        num_entries = atar.num_entries
+
+        if isinstance(step_size, str):
+            step_size = atar.num_entries_for(step_size, self.atar_branches)
+
+        if isinstance(entry, str) and entry == 'All':
+            entry = slice(None)
+
+        if isinstance(entry, (int, np.integer)):
+            if not -num_entries <= entry < num_entries:
+                raise IndexError('entry {0} is out of range for {1} entries'.format(entry, num_entries))
+            entry = slice(entry % num_entries, entry % num_entries + 1)
+
+        if isinstance(entry, slice) and entry.step in (None, 1):
+            start, stop, _ = entry.indices(num_entries)
+            indices = None
+            total = max(0, stop - start)
+        else:
+            if isinstance(entry, slice):
+                indices = np.arange(*entry.indices(num_entries))
+            else:
+                indices = np.asarray(entry)
+
+                if indices.dtype == bool:
+                    if len(indices) != num_entries:
+                        raise IndexError('boolean entry mask has length {0}, the tree has {1} entries'.format(len(indices), num_entries))
+                    indices = np.nonzero(indices)[0]
+                elif len(indices) and (indices.min() < -num_entries or indices.max() >= num_entries):
+                    raise IndexError('entries are out of range for {0} entries'.format(num_entries))
+
+                indices = indices.astype(np.int64) % max(num_entries, 1)
+
+            total = len(indices)
+
+            #An ascending run without gaps is just a range
+
+            if total and np.all(np.diff(indices) == 1):
+                start, stop = int(indices[0]), int(indices[-1]) + 1
+                indices = None
+
+        if total == 0:
+            return []
+
+        if workers > 1:
+            step_size = min(step_size, -(-total // (4 * workers)))
+
+        step_size = max(1, step_size)
+
+        if indices is None:
+            return [[(begin, min(begin + step_size, stop), None)] for begin in range(start, stop, step_size)]
+
+        #Cut the selection where it changes basket cluster and every step_size entries
+
+        cluster_offsets = np.asarray(atar.common_entry_offsets())
+        cluster = np.searchsorted(cluster_offsets, indices, side = 'right')
+
+        cuts = np.nonzero(np.diff(cluster))[0] + 1
+        cuts = np.union1d(cuts, np.arange(step_size, total, step_size))
+
+        tasks = []
+
+        for begin, end in zip(np.concatenate([[0], cuts]), np.concatenate([cuts, [total]])):
+
+            run = indices[begin:end]
+            first = int(run.min())
+
+            if not tasks or sum(len(local) for _, _, local in tasks[-1]) + len(run) > step_size:
+                tasks.append([])
+
+            tasks[-1].append((first, int(run.max()) + 1, run - first))
+
+        return tasks
+
+
+    def compute_energy_sharing(self, root_path, spline = None, entry = "All", step_size = "100 MB", workers = 1, output_dir = None, keep = None, pipeline = False, prefetch = 2, io_threads = 4, checkpoint = False):
+
+        '''
+        Writes a new root file of the form 'digitized <root_path>' in output_dir (the current working directory by default)
+        and returns its path. Must be called with a path to the root file you want to digitize and a spline for energy sharing
+        (built from path_to_spline if not given). The new root file has a digitized_atar tree with energy sharing data computed.
+        If no event is specified, it will compute energy sharing for all entries. entry can be an int, a slice, an array of
+        entry numbers or a boolean mask, and only the baskets holding the selected entries are read (see entry_tasks).
+        The atar tree is streamed in chunks of step_size (a number of entries or a size such as "100 MB") and every
+        chunk is appended to the digitized_atar TTree as soon as it is computed, so memory use does not grow with the file.
+        With workers > 1 the chunks are digitized in a process pool (each worker holds its own copy of the spline)
+        and written back in entry order. With pipeline = True (and one worker) reading, computing and writing overlap:
+        a reader thread decompresses the next chunks on io_threads threads, a writer thread flushes the previous ones
+        while the current one is computed, with at most prefetch chunks queued between the stages.
+        The input file is not copied: only the trees named in keep are passed through, also in chunks. keep is a list of
+        tree names, or a dict from tree name to the list of branches to keep (None for all of them). Trees with as many
+        entries as atar are cut to the same entries as digitized_atar.
+        With checkpoint = True every finished chunk is saved next to the output (in '<output>.parts', with a
+        progress.json manifest) and the output file is only assembled from the parts once all chunks are done.
+        Calling again with the same arguments after a kill skips the chunks already saved; the assembled file
+        has the same trees, baskets and contents as an uninterrupted run. The parts are removed afterwards.
+        '''
+
+        import uproot
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+        start = time.perf_counter()
+        stats = _nostats if self.stats is None else self.stats
+        before = dict(stats.counts) if self.stats is not None else None
+
+        dest = os.path.join(os.getcwd() if output_dir is None else output_dir, 'digitized' + os.path.basename(root_path))
+
+        #Built here also for workers, which get a copy, so a checkpoint can be keyed by the spline used
+
+        if spline is None:
+            spline = self.build_spline()
+
+        if keep is None:
+            keep = {}
+        elif not isinstance(keep, dict):
+            keep = dict.fromkeys(keep)
+
+        
+        with uproot.open(root_path) as infile, uproot.recreate(dest, compression = self.output_compression()) as outfile:
+
+            atar = infile['atar']
+
+            tasks = self.entry_tasks(atar, entry, step_size, workers)
+
+            hits = hitcache(atar, self.atar_branches, self.hit_cache_dir, step_size) if self.hit_cache else None
+
+            key = file_key(infile) if self.smearing is not None else 0
+
+            outtree = _basketwriter(outfile.mktree('digitized_atar', self.branch_types), self.basket_size)
+
+            progress = None
+
+            if checkpoint:
+                progress = _checkpoint(dest, self._checkpoint_key(root_path, tasks, spline), len(tasks))
+
+            todo = range(len(tasks)) if progress is None else progress.todo()
+
+            def store(index, fragments):
+                with stats.timer('write'):
+                    if progress is None:
+                        outtree.extend(fragments)
+                    else:
+                        progress.save(index, fragments)
+
+            if workers == 1:
+
+                executors = {}
+
+                def read(index):
+                    with stats.timer('read'):
+                        if hits is not None:
+                            return index, hits.read(tasks[index])
+                        return index, _read_runs(atar, self.atar_branches, tasks[index], executors)
+
+                def compute(chunk):
+                    index, data = chunk
+                    with stats.timer('compute'):
+                        return index, data, _columns(self.digitize(data, spline, _run_entries(tasks[index]), key))
+
+                def write(chunk):
+                    index, data, fragments = chunk
+                    store(index, fragments)
+                    if self.stats is not None:
+                        self.stats.add_chunk(*_chunk_counts(atar if hits is None else None, self.atar_branches, tasks[index], data, fragments))
+
+                if pipeline:
+
+                    #uproot decompresses and interprets the baskets of a chunk on these threads
+
+                    with ThreadPoolExecutor(io_threads) as decompression, ThreadPoolExecutor(io_threads) as interpretation:
+
+                        executors.update(decompression_executor = decompression, interpretation_executor = interpretation)
+
+                        _pipeline(todo, read, compute, write, prefetch)
+
+                else:
+
+                    for index in todo:
+                        write(compute(read(index)))
+
+            else:
+
+                with ProcessPoolExecutor(workers, initializer = _init_worker, initargs = (self, spline)) as executor:
+
+                    #Keep at most two tasks per worker in flight and write the results in submission (entry) order
+
+                    pending = deque()
+
+                    for index in list(todo) + [None] * (2 * workers - 1):
+
+                        if index is not None:
+                            pending.append((index, executor.submit(_digitize_runs, root_path, tasks[index], self.stats is not None, hits)))
+
+                        if pending and (len(pending) >= 2 * workers or index is None):
+
+                            done, future = pending.popleft()
+                            fragments, counts = future.result()
+
+                            store(done, fragments)
+
+                            if counts is not None:
+                                self.stats.add_chunk(*counts)
+
+            with stats.timer('write'):
+
+                if progress is not None:
+
+                    jagged = [name for name, kind in self.branch_types.items() if kind.startswith('var')]
+
+                    for index in range(len(tasks)):
+                        outtree.extend(progress.load(index, jagged))
+
+                outtree.close()
+
+            #Pass through trees
+
+            for name, branches in keep.items():
+
+                intree = infile[name]
+
+                with stats.timer('write'):
+                    _copy_tree(intree, outfile, branches, step_size, tasks if intree.num_entries == atar.num_entries else None, self.basket_size)
+
+        if progress is not None:
+            progress.remove()
+
+        if self.stats is not None:
+            self.stats.add_run(root_path, dest, time.perf_counter() - start, before)
+
+        return dest
+
+
+    def compute_time_frames(self, root_path, frame_length, rate = None, spacing = None, seed = 0, spline = None, entry = "All", step_size = "100 MB", output_dir = None, merge_window = None):
+
+        '''
+        Continuous readout: digitizes the atar hits of consecutive entries as one stream cut into time frames of
+        frame_length (pixel_time units, ns) and writes one entry per frame to an atar_frames tree of a new file
+        'frames <root_path>' in output_dir (the current working directory by default), whose path is returned.
+        Every entry is shifted by a time offset: with a rate (in Hz) entries arrive as a poisson process, the gaps
+        drawn from a numpy Generator seeded with seed; with a spacing (ns) entry i starts at i * spacing; with neither
+        the pixel_time of the hits is taken as absolute. Frames hold the hits of all entries in
+        [frame * frame_length, (frame + 1) * frame_length), so entries pile up, and are digitized like events (energy
+        sharing, threshold) with the fragments on the same strip merged within merge_window (self.merge_window, or the
+        whole frame if that is None too). pixel_time in the output is absolute. Only frames with hits are written,
+        with their frame number and start time.
+        The entries (selected with entry, read in chunks of step_size) are merged into the time ordered stream with a
+        sort-merge: hits from a chunk are sorted into a carry buffer, and every frame that ends before the watermark,
+        the offset of the last entry read (no later hit can be earlier, pixel_time being non negative), is digitized
+        and written. Memory is bounded by a chunk plus the hits not yet in a finished frame; without a rate or a
+        spacing nothing finishes before the end, so rate scans should set one of them.
+        '''
+
+        import copy
+        import uproot
+        import awkward as ak
+
+        start = time.perf_counter()
+        stats = _nostats if self.stats is None else self.stats
+        before = dict(stats.counts) if self.stats is not None else None
+
+        if spline is None:
+            spline = self.build_spline()
+
+        framer = copy.copy(self)
+        framer.stats = None
+        framer.merge_window = frame_length if merge_window is None and self.merge_window is None else (self.merge_window if merge_window is None else merge_window)
+
+        rng = np.random.default_rng(seed)
+
+        dest = os.path.join(os.getcwd() if output_dir is None else output_dir, 'frames' + os.path.basename(root_path))
+
+        branch_types = dict(framer.branch_types, frame = 'int64', frame_time = 'float64')
+
+        #The carry buffer: time sorted hits not yet in a finished frame
+
+        carry = dict((name, np.zeros(0, dtype)) for name, dtype in (('pixel_hits', np.int64), ('pixel_edep', np.float64), ('pixel_time', np.float64), ('pixel_pdg', np.int64)))
+        last_offset = 0.
+        entries_read = 0
+        earliest = 0.
+
+        def write_frames(hits, outtree):
+
+            frames = np.floor(hits['pixel_time'] / frame_length).astype(np.int64)
+            numbers, counts = np.unique(frames, return_counts = True)
+
+            with stats.timer('compute'):
+                events = ak.zip(dict((name, ak.unflatten(values, counts)) for name, values in hits.items()), depth_limit = 1)
+                fragments = _columns(framer.digitize(events, spline, numbers, key))
+
+            fragments.update(frame = numbers, frame_time = numbers * float(frame_length))
+
+            with stats.timer('write'):
+                outtree.extend(fragments)
+
+            return fragments
+
+        with uproot.open(root_path) as infile, uproot.recreate(dest, compression = self.output_compression()) as outfile:
+
+            atar = infile['atar']
+            tasks = self.entry_tasks(atar, entry, step_size)
+            hitstore = hitcache(atar, self.atar_branches, self.hit_cache_dir, step_size) if self.hit_cache else None
+            key = file_key(infile) if self.smearing is not None else 0
+
+            outtree = _basketwriter(outfile.mktree('atar_frames', branch_types), self.basket_size)
+
+            for task in tasks + [None]:
+
+                if task is not None:
+
+                    with stats.timer('read'):
+                        data = _read_runs(atar, self.atar_branches, task) if hitstore is None else hitstore.read(task)
+
+                    #Entry offsets, continuing the stream of the previous chunks
+
+                    index = np.arange(entries_read, entries_read + len(data))
+
+                    if rate is not None:
+                        offsets = np.cumsum(np.concatenate([[last_offset], rng.exponential(1e9 / rate, len(data))]))[1:]
+                    elif spacing is not None:
+                        offsets = index * float(spacing)
+                    else:
+                        offsets = np.zeros(len(data))
+
+                    entries_read += len(data)
+                    last_offset = offsets[-1] if len(data) else last_offset
+
+                    counts = ak.to_numpy(ak.num(data['pixel_hits']))
+
+                    new = {
+                        'pixel_hits': ak.to_numpy(ak.flatten(data['pixel_hits'])).astype(np.int64),
+                        'pixel_edep': ak.to_numpy(ak.flatten(data['pixel_edep'])).astype(np.float64),
+                        'pixel_time': ak.to_numpy(ak.flatten(data['pixel_time'])).astype(np.float64) + np.repeat(offsets, counts),
+                        'pixel_pdg': ak.to_numpy(ak.flatten(data['pixel_pdg'])).astype(np.int64)
+                    }
+
+                    earliest = min(earliest, float(np.min(new['pixel_time'] - np.repeat(offsets, counts), initial = 0.)))
+
+                    #Merge into the carry buffer; a stable sort keeps the entry order of simultaneous hits
+
+                    merged = dict((name, np.concatenate([carry[name], new[name]])) for name in carry)
+                    order = np.argsort(merged['pixel_time'], kind = 'stable')
+                    merged = dict((name, values[order]) for name, values in merged.items())
+
+                    #Frames ending before the watermark are complete
+
+                    watermark = last_offset + earliest
+                    cut = np.searchsorted(merged['pixel_time'], np.floor(watermark / frame_length) * frame_length, side = 'left')
+
+                else:
+
+                    data = None
+                    merged = carry
+                    cut = len(merged['pixel_time'])
+
+                done = dict((name, values[:cut]) for name, values in merged.items())
+                carry = dict((name, values[cut:]) for name, values in merged.items())
+
+                fragments = write_frames(done, outtree) if cut else None
+
+                if self.stats is not None:
+
+                    n_fragments = 0 if fragments is None else int(ak.sum(ak.num(fragments['pixel_hits'])))
+
+                    if data is not None:
+                        bytes_read = _chunk_counts(atar if hitstore is None else None, self.atar_branches, task, data, data)[3]
+                        self.stats.add_chunk(len(data), int(np.sum(counts)), n_fragments, bytes_read)
+                    else:
+                        self.stats.counts['fragments'] += n_fragments
+
+            with stats.timer('write'):
+                outtree.close()
+
+        if self.stats is not None:
+            self.stats.add_run(root_path, dest, time.perf_counter() - start, before)
+
+        return dest
+
+
+    def _checkpoint_key(self, root_path, tasks, spline):
+
+        '''
+            What a checkpoint is valid for: the input file, the tasks, the spline (by content, so rewriting the
+            response file or passing another spline invalidates it) and every setting that changes the output.
+        '''
+
+        import hashlib
+
+        stat = os.stat(root_path)
+
+        settings = [self.path_to_spline, self.pixel_pitch, self.pixels_per_plane, self.n, self.n_planes, self.model, self.strip_width,
+                    self.dtypes, self.threshold, self.suppression, self.merge_window, self.smearing]
+
+        return {
+            'input': [os.path.abspath(root_path), stat.st_size, stat.st_mtime_ns],
+            'tasks': _checkpoint.task_key(tasks),
+            'spline': hashlib.sha1(np.ascontiguousarray(spline.x).tobytes() + np.ascontiguousarray(spline.c).tobytes()).hexdigest(),
+            'settings': repr(settings)
+        }
+
+
+    def __getstate__(self):
+
+        #Stats (and their callback) stay in the parent process, workers report their counts back
+
+        state = self.__dict__.copy()
+        state['stats'] = None
+
+        return state
+
+
+
+def sweep(root_path, configurations, entry = "All", step_size = "100 MB", output_dir = None, keep = None, stats = None):
+
+    '''
+        Digitizes a file with several configurations in one pass over its atar tree. configurations is a list of
+        dicts of digitizeatar arguments (path_to_spline, pixel_pitch, pixels_per_plane, n, threshold, ...), each with
+        a 'tag' (its position in the list if missing), or of (tag, digitizeatar) pairs. Every chunk of step_size
+        entries is read once and digitized by every configuration, and the fragments of each go to their own
+        digitized_atar_<tag> tree of 'digitized <root_path>' in output_dir (the current working directory by default),
+        whose path is returned. entry and keep work as in compute_energy_sharing. The file is compressed with the
+        settings of the first configuration and read through its hitcache if it has
+        hit_cache set; the basket size and dtypes of every tree follow its own configuration.
+        stats is an optional digitizerstats; the fragments it counts are summed over the configurations.
+    '''
+
+    import uproot
+    import awkward as ak
+
+    start = time.perf_counter()
+    timers = _nostats if stats is None else stats
+    before = dict(stats.counts) if stats is not None else None
+
+    digitizers = []
+
+    for index, configuration in enumerate(configurations):
+
+        if isinstance(configuration, dict):
+            configuration = dict(configuration)
+            tag = configuration.pop('tag', index)
+            digitizer = digitizeatar(**configuration)
+        else:
+            tag, digitizer = configuration
+
+        digitizers.append((str(tag), digitizer))
+
+    tags = [tag for tag, _ in digitizers]
+
+    if len(set(tags)) != len(tags):
+        raise ValueError('sweep configurations need distinct tags, got {0}'.format(tags))
+
+    splines = [digitizer.build_spline() for _, digitizer in digitizers]
+    first = digitizers[0][1]
+
+    dest = os.path.join(os.getcwd() if output_dir is None else output_dir, 'digitized' + os.path.basename(root_path))
+
+    if keep is None:
+        keep = {}
+    elif not isinstance(keep, dict):
+        keep = dict.fromkeys(keep)
+
+    with uproot.open(root_path) as infile, uproot.recreate(dest, compression = first.output_compression()) as outfile:
+
+        atar = infile['atar']
+
+        tasks = first.entry_tasks(atar, entry, step_size)
+
+        hits = hitcache(atar, first.atar_branches, first.hit_cache_dir, step_size) if first.hit_cache else None
+        key = file_key(infile)
+
+        outtrees = [_basketwriter(outfile.mktree('digitized_atar_' + tag, digitizer.branch_types), digitizer.basket_size) for tag, digitizer in digitizers]
+
+        for task in tasks:
+
+            with timers.timer('read'):
+                data = _read_runs(atar, first.atar_branches, task) if hits is None else hits.read(task)
+
+            n_fragments = 0
+
+            for (_, digitizer), spline, outtree in zip(digitizers, splines, outtrees):
+
+                with timers.timer('compute'):
+                    fragments = _columns(digitizer.digitize(data, spline, _run_entries(task), key))
+
+                with timers.timer('write'):
+                    outtree.extend(fragments)
+
+                n_fragments += int(ak.sum(ak.num(fragments['pixel_hits'])))
+
+            if stats is not None:
+                events, n_hits, _, bytes_read, _ = _chunk_counts(atar if hits is None else None, first.atar_branches, task, data, fragments)
+                stats.add_chunk(events, n_hits, n_fragments, bytes_read)
+
+        with timers.timer('write'):
+
+            for outtree in outtrees:
+                outtree.close()
+
+            for name, branches in keep.items():
+                intree = infile[name]
+                _copy_tree(intree, outfile, branches, step_size, tasks if intree.num_entries == atar.num_entries else None, first.basket_size)
+
+    if stats is not None:
+        stats.add_run(root_path, dest, time.perf_counter() - start, before)
+
+    return dest
+
+
+
+def _run_entries(runs):
+    '''
+    Entry numbers of the (entry_start, entry_stop, local) runs of a task, in order.
+    '''
+    return np.concatenate([np.arange(entry_start, entry_stop) if local is None else np.arange(entry_start, entry_stop)[local] for entry_start, entry_stop, local in runs])
+
+
+def _columns(array):
+    '''
+    The fields of a record array as a dict of arrays, the form the tree writers take.
+    '''
+
+    import awkward as ak
+
+    return dict(zip(ak.fields(array), ak.unzip(array)))
+
+
+def _chunk_counts(tree, branches, runs, data, fragments, seconds = None):
+    '''
+    Returns the digitizerstats.add_chunk arguments for a chunk: events, hits, fragments, the compressed
+    size of the baskets read for it (none if tree is None, i.e. read from a hitcache) and optionally
+    the seconds spent per stage.
+    '''
+
+    import awkward as ak
+
+    bytes_read = 0
+
+    for name in (branches if tree is not None else []):
+
+        branch = tree[name]
+        offsets = branch.entry_offsets
+
+        for entry_start, entry_stop, _ in runs:
+            first = np.searchsorted(offsets, entry_start, side = 'right') - 1
+            last = np.searchsorted(offsets, entry_stop, side = 'left')
+            bytes_read += sum(branch.basket_compressed_bytes(i) for i in range(first, last))
+
+    hits = int(ak.sum(ak.num(data['pixel_hits'])))
+    n_fragments = int(ak.sum(ak.num(fragments['pixel_hits'])))
+
+    return len(data), hits, n_fragments, bytes_read, seconds
+
+
+def _pipeline(tasks, read, compute, write, depth = 2):
+
+    '''
+        Runs write(compute(read(task))) for every task with the three stages overlapped: a reader thread
+        works ahead on the next tasks and a writer thread flushes earlier results while compute runs on the
+        calling thread. The queues between the stages hold at most depth items, so a slow stage holds back
+        the others and memory stays bounded. Results are written in task order. An exception in any stage
+        stops the others and is raised here.
+    '''
+
+    import queue
+    import threading
+
+    done = object()
+    stop = threading.Event()
+    errors = []
+
+    read_queue = queue.Queue(depth)
+    write_queue = queue.Queue(depth)
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout = 0.1)
+            except queue.Empty:
+                pass
+        return done
+
+    def reader():
+        try:
+            for task in tasks:
+                if not put(read_queue, read(task)):
+                    return
+            put(read_queue, done)
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
+
+    def writer():
+        try:
+            for item in iter(lambda: get(write_queue), done):
+                write(item)
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
+
+    threads = [threading.Thread(target = reader, daemon = True), threading.Thread(target = writer, daemon = True)]
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        for item in iter(lambda: get(read_queue), done):
+            if not put(write_queue, compute(item)):
+                break
+
+        put(write_queue, done)
+
+    except BaseException:
+        stop.set()
+        raise
+
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def merge_strip_fragments(per_event, strips, energies, times, pdgs, window):
+
+    '''
+        Merges the fragments of each event that are on the same strip and close in time, given flat
+        fragment arrays and the number of fragments per event. Fragments are sorted by event, strip and
+        time, and a fragment joins the group before it if it is on the same strip of the same event and
+        no more than window after the previous fragment (so a train of close fragments merges into one).
+        Each group keeps the summed energy, the earliest time and the pdg of its largest fragment.
+        Everything is done with sorts and segmented reductions. Returns the merged strips, energies, times,
+        pdgs (sorted by strip and time within each event, same dtypes) and the new number per event.
+    '''
+
+    per_event = np.asarray(per_event)
+    events = np.repeat(np.arange(len(per_event)), per_event)
+
+    order = np.lexsort((times, strips, events))
+
+    events = events[order]
+    strips = strips[order]
+    times = times[order]
+    energies = energies[order]
+    pdgs = pdgs[order]
+
+    #A group starts wherever the event or the strip changes or the time gap is larger than the window
+
+    starts = np.ones(len(order), dtype = bool)
+    starts[1:] = (events[1:] != events[:-1]) | (strips[1:] != strips[:-1]) | (times[1:] - times[:-1] > window)
+
+    first = np.nonzero(starts)[0]
+    group = np.cumsum(starts) - 1
+
+    merged = np.add.reduceat(energies.astype(np.float64), first).astype(energies.dtype) if len(first) else energies
+
+    #The largest fragment of every group comes first when sorted by group and decreasing energy
+
+    dominant = np.lexsort((-energies, group))[first] if len(first) else first
+
+    return strips[first], merged, times[first], pdgs[dominant], np.bincount(events[first], minlength = len(per_event))
+
+
+def _check_fits(values, dtype, name, margin = 0):
+    '''
+    Raises an OverflowError if integer values (widened by margin on both sides) do not fit in dtype.
+    '''
+
+    dtype = np.dtype(dtype)
+
+    if dtype.kind in 'iu' and len(values):
+        info = np.iinfo(dtype)
+
+        if values.min() - margin < info.min or values.max() + margin > info.max:
+            raise OverflowError('{0} values from {1} to {2} do not fit in {3}'.format(name, values.min() - margin, values.max() + margin, dtype))
+
+
+def _read_runs(tree, branches, runs, executors = None):
+    '''
+    Reads the (entry_start, entry_stop, local) runs of a task from a tree and concatenates them.
+    executors optionally holds uproot's decompression_executor and interpretation_executor.
+    '''
+
+    import awkward as ak
+
+    parts = []
+
+    for entry_start, entry_stop, local in runs:
+
+        data = tree.arrays(branches, entry_start = entry_start, entry_stop = entry_stop, **(executors or {}))
+
+        parts.append(data if local is None else data[local])
+
+    return parts[0] if len(parts) == 1 else ak.concatenate(parts)
+
+
+def _copy_tree(intree, outfile, branches = None, step_size = "100 MB", tasks = None, basket_size = None):
+    '''
+    Copies the branches of a tree (all of them if None, leaving out counter branches, which uproot
+    writes again) to a new tree of the same name in outfile, one chunk at a time. With tasks (from
+    digitizeatar.entry_tasks) only the selected entries are copied.
+    '''
+
+    if branches is None:
+        counters = set(branch.count_branch.name for branch in intree.branches if branch.count_branch is not None)
+        branches = [name for name in intree.keys(recursive = False) if name not in counters]
+
+    if tasks is None:
+        chunks = intree.iterate(branches, step_size = step_size)
+    else:
+        chunks = (_read_runs(intree, branches, task) for task in tasks)
+
+    outtree = None
+
+    for chunk in chunks:
+
+        if outtree is None:
+            outtree = _basketwriter(outfile.mktree(intree.name, dict((name, chunk[name].type) for name in chunk.fields)), basket_size)
+
+        outtree.extend(dict((name, chunk[name]) for name in chunk.fields))
+
+    if outtree is not None:
+        outtree.close()
+
+
+
+class _basketwriter:
+
+    '''
+        Extends a tree in baskets of basket_size entries, buffering smaller chunks and splitting larger
+        ones. With basket_size None every chunk becomes one basket. close writes what is left.
+    '''
+
+    def __init__(self, tree, basket_size = None):
+        self.tree = tree
+        self.basket_size = basket_size
+        self.buffer = []
+        self.buffered = 0
+
+
+    def extend(self, arrays):
+
+        if self.basket_size is None:
+            self.tree.extend(arrays)
+            return
+
+        self.buffer.append(arrays)
+        self.buffered += len(next(iter(arrays.values())))
+
+        if self.buffered >= self.basket_size:
+            self._flush(False)
+
+
+    def close(self):
+        if self.buffered:
+            self._flush(True)
+
+
+    def _flush(self, last):
+
+        import awkward as ak
+
+        arrays = dict((name, ak.concatenate([part[name] for part in self.buffer])) for name in self.buffer[0])
+
+        stop = self.buffered if last else self.buffered - self.buffered % self.basket_size
+
+        for start in range(0, stop, self.basket_size):
+            self.tree.extend(dict((name, array[start:min(start + self.basket_size, stop)]) for name, array in arrays.items()))
+
+        self.buffer = [dict((name, array[stop:]) for name, array in arrays.items())] if stop < self.buffered else []
+        self.buffered -= stop
+
+
+class _checkpoint:
+
+    '''
+        Progress of a checkpointed compute_energy_sharing run. Every finished task is saved as
+        <dest>.parts/<task>.npz (flat contents and counts per branch) and recorded in progress.json
+        there, both written to a temporary name and renamed so a kill never leaves a half written
+        part. The manifest holds a key of the input file, the tasks and the digitizer settings;
+        parts from a run with another key are thrown away. remove deletes the directory once the
+        output file is assembled.
+    '''
+
+    def __init__(self, dest, key, n_tasks):
+
+        self.path = dest + '.parts'
+        self.manifest = os.path.join(self.path, 'progress.json')
+        self.key = key
+        self.n_tasks = n_tasks
+        self.done = set()
+
+        if os.path.exists(self.manifest):
+
+            with open(self.manifest) as f:
+                progress = json.load(f)
+
+            if progress['key'] == key and progress['tasks'] == n_tasks:
+                self.done = set(progress['done'])
+            else:
+                self.remove()
+
+        os.makedirs(self.path, exist_ok = True)
+
+
+    def todo(self):
+        return [index for index in range(self.n_tasks) if index not in self.done]
+
+
+    def save(self, index, fragments):
+
+        import awkward as ak
+
+        arrays = {}
+
+        for name, array in fragments.items():
+            if array.ndim > 1:
+                arrays[name] = ak.to_numpy(ak.flatten(array))
+                arrays['counts'] = ak.to_numpy(ak.num(array))
+            else:
+                arrays[name] = ak.to_numpy(array)
+
+        part = os.path.join(self.path, '{0}.npz'.format(index))
+
+        with open(part + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+
+        os.replace(part + '.tmp', part)
+
+        self.done.add(index)
+
+        with open(self.manifest + '.tmp', 'w') as f:
+            json.dump({'key': self.key, 'tasks': self.n_tasks, 'done': sorted(self.done)}, f)
+
+        os.replace(self.manifest + '.tmp', self.manifest)
+
+
+    def load(self, index, jagged):
+
+        import awkward as ak
+
+        with np.load(os.path.join(self.path, '{0}.npz'.format(index))) as part:
+            return dict((name, ak.unflatten(part[name], part['counts']) if name in jagged else part[name]) for name in part.files if name != 'counts')
+
+
+    def remove(self):
+
+        import shutil
+
+        shutil.rmtree(self.path, ignore_errors = True)
+
+
+    @staticmethod
+    def task_key(tasks):
+
+        '''
+            A digest of the (entry_start, entry_stop, local) runs of every task.
+        '''
+
+        import hashlib
+
+        digest = hashlib.sha1()
+
+        for task in tasks:
+            for entry_start, entry_stop, local in task:
+                digest.update(repr((entry_start, entry_stop)).encode())
+                digest.update(b'' if local is None else np.ascontiguousarray(local, dtype = np.int64).tobytes())
+            digest.update(b';')
+
+        return digest.hexdigest()
+
+
+#Compiled Numba kernels, built on first use
+
+_numba = {}
+
+
+def _numba_kernels():
+    '''
+    Compiles (once per process) and returns the Numba sharing kernels, or None if Numba is not installed.
+    '''
+
+    if 'kernels' in _numba:
+        return _numba['kernels']
+
+    try:
+        import numba
+    except ImportError:
+        import warnings
+        warnings.warn('numba is not installed, using the numpy energy sharing kernel')
+        _numba['kernels'] = None
+        return None
+
+    @numba.njit(parallel = True)
+    def suppress(hit_offsets, hits, edep, pattern, valid, weights, n, threshold, renormalize, out_per_hit, out_scale, out_lost):
+
+        #Fragments of every hit that pass the threshold, the factor putting the suppressed energy back
+        #on them (renormalize) and the energy each event loses
+
+        for event in numba.prange(len(hit_offsets) - 1):
+
+            lost = 0.
+
+            for i in range(hit_offsets[event], hit_offsets[event + 1]):
+
+                row = pattern[hits[i]]
+                kept = 0
+                kept_energy = 0.
+
+                for j in range(2 * n + 1):
+                    if valid[row, j]:
+                        energy = weights[row, j] * edep[i]
+                        if energy >= threshold:
+                            kept += 1
+                            kept_energy += energy
+                        elif not renormalize:
+                            lost += energy
+
+                out_per_hit[i] = kept
+
+                if renormalize:
+                    if kept_energy != 0:
+                        out_scale[i] = edep[i] / kept_energy
+                    else:
+                        out_scale[i] = 0.
+                        lost += edep[i]
+
+            out_lost[event] = lost
+
+    @numba.njit(parallel = True)
+    def share(hit_offsets, fragment_offsets, hits, edep, time, pdg, pattern, valid, weights, n, suppress, threshold, renormalize, scale, out_hits, out_edep, out_time, out_pdg):
+
+        #Events are independent, each hit writes its fragments from fragment_offsets[hit] on
+
+        for event in numba.prange(len(hit_offsets) - 1):
+            for i in range(hit_offsets[event], hit_offsets[event + 1]):
+
+                k = fragment_offsets[i]
+                row = pattern[hits[i]]
+
+                for j in range(2 * n + 1):
+                    if valid[row, j]:
+
+                        energy = weights[row, j] * edep[i]
+
+                        if suppress and not energy >= threshold:
+                            continue
+
+                        out_hits[k] = hits[i] + j - n
+                        out_edep[k] = energy * scale[i] if renormalize else energy
+                        out_time[k] = time[i]
+                        out_pdg[k] = pdg[i]
+                        k += 1
+
+    _numba['kernels'] = {'suppress': suppress, 'share': share}
+
+    return _numba['kernels']
+
+
+
+#Per process state of the worker pool used by compute_energy_sharing
+
+_worker = {}
+
+
+def _init_worker(digitizer, spline):
+    '''
+    Runs once in every worker process. Builds the spline unless one was handed over.
+    '''
+    _worker['digitizer'] = digitizer
+    _worker['spline'] = digitizer.build_spline() if spline is None else spline
+
+
+def _digitize_runs(root_path, runs, instrument = False, hits = None):
+    '''
+    Reads (from hits, a hitcache, if given) and digitizes the (entry_start, entry_stop, local) runs of a task
+    in a worker process. Returns the fragments and, if instrument, the digitizerstats.add_chunk arguments for them.
+    '''
+    import uproot
+
+    digitizer = _worker['digitizer']
+    seconds = {'read': 0., 'compute': 0.}
+
+    key = file_key(root_path) if digitizer.smearing is not None else 0
+
+    if hits is not None:
+
+        with _stagetimer(seconds, 'read'):
+            data = hits.read(runs)
 
-                tree['pixel_pdg'].append(pdg_list)
-                tree['pixel_edep'].append(edep_list)
-                tree['pixel_time'].append(time_list)
-                tree['pixel_hits'].append(hits_list)
+        with _stagetimer(seconds, 'compute'):
+            fragments = _columns(digitizer.digitize(data, _worker['spline'], _run_entries(runs), key))
 
-        # Add on TTree
-        with uproot.update(dest) as f:
-            f['digitized_atar'] = tree
-            
+        return fragments, _chunk_counts(None, digitizer.atar_branches, runs, data, fragments, seconds) if instrument else None
 
-    
+    with uproot.open(root_path + ':atar') as infile:
 
+        with _stagetimer(seconds, 'read'):
+            data = _read_runs(infile, digitizer.atar_branches, runs)
 
-    
+        with _stagetimer(seconds, 'compute'):
+            fragments = _columns(digitizer.digitize(data, _worker['spline'], _run_entries(runs), key))
 
+        counts = _chunk_counts(infile, digitizer.atar_branches, runs, data, fragments, seconds) if instrument else None
 
+    return fragments, counts
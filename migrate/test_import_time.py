@@ -0,0 +1,48 @@
+'''
+    Keeps importing the digitizer cheap: energy_sharingv3 must load only numpy and the standard
+    library at import time, the heavy packages being imported inside the functions that use them.
+    Run with python -m pytest migrate/test_import_time.py
+'''
+
+import os
+import sys
+import json
+import subprocess
+
+#Seconds energy_sharingv3 may add on top of numpy; it takes a few ms, a top level uproot import about a second
+
+import_budget = 0.25
+
+heavy_modules = ['uproot', 'awkward', 'scipy', 'hist', 'matplotlib']
+
+
+def _import_in_fresh_process():
+
+    code = '''
+import sys, time, json
+import numpy
+start = time.perf_counter()
+import energy_sharingv3
+module_s = time.perf_counter() - start
+print(json.dumps({'module_s': module_s, 'modules': sorted(sys.modules)}))
+'''
+
+    output = subprocess.check_output([sys.executable, '-c', code], cwd = os.path.dirname(os.path.abspath(__file__)))
+
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def test_import_loads_no_heavy_modules():
+
+    modules = set(_import_in_fresh_process()['modules'])
+
+    assert [name for name in heavy_modules if name in modules] == []
+
+
+def test_import_time_budget():
+
+    #Best of a few runs, so a busy machine does not fail the budget
+
+    module_s = min(_import_in_fresh_process()['module_s'] for _ in range(3))
+
+    assert module_s < import_budget, 'importing energy_sharingv3 took {0:.3f} s on top of numpy'.format(module_s)